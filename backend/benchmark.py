@@ -0,0 +1,570 @@
+"""
+Benchmark harness for the ingestion, clustering and search hot paths.
+
+Generates a synthetic corpus offline, times each stage directly and the
+end-to-end API through a test client, and writes the results as JSON so
+runs can be compared to catch regressions.
+
+Memory is reported per stage as the peak growth in resident set size over the
+RSS before the stage, so allocations made inside torch count too. Linux lets a
+process reset its RSS high-water mark, so this is measured during the timed
+calls. Elsewhere it falls back to the peak Python/NumPy allocation traced with
+tracemalloc in a separate pass, which does not see torch.
+
+Usage:
+    python benchmark.py --docs 1000 --output bench.json
+    python benchmark.py --docs 1000 --compare bench.json
+"""
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from datetime import datetime
+from pathlib import Path
+import argparse
+import json
+import platform
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+from docx import Document
+
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+
+# Topic vocabularies used to build documents that actually cluster
+TOPIC_VOCABULARIES = {
+    'finance': [
+        'market', 'stock', 'investor', 'dividend', 'portfolio', 'bond', 'interest',
+        'inflation', 'revenue', 'earnings', 'bank', 'loan', 'credit', 'asset',
+        'equity', 'fund', 'trading', 'currency', 'budget', 'profit'
+    ],
+    'health': [
+        'patient', 'doctor', 'hospital', 'treatment', 'disease', 'vaccine', 'clinic',
+        'symptom', 'therapy', 'medicine', 'nurse', 'diagnosis', 'surgery', 'virus',
+        'infection', 'health', 'drug', 'trial', 'recovery', 'care'
+    ],
+    'sports': [
+        'team', 'player', 'match', 'season', 'coach', 'goal', 'league', 'score',
+        'tournament', 'championship', 'stadium', 'fan', 'referee', 'victory',
+        'defeat', 'training', 'athlete', 'medal', 'race', 'cup'
+    ],
+    'technology': [
+        'software', 'computer', 'network', 'algorithm', 'data', 'cloud', 'server',
+        'processor', 'database', 'application', 'developer', 'code', 'security',
+        'internet', 'device', 'robot', 'chip', 'platform', 'model', 'system'
+    ],
+    'environment': [
+        'climate', 'forest', 'ocean', 'pollution', 'carbon', 'emission', 'energy',
+        'wildlife', 'species', 'river', 'drought', 'temperature', 'glacier',
+        'recycling', 'solar', 'wind', 'habitat', 'conservation', 'soil', 'rain'
+    ],
+    'law': [
+        'court', 'judge', 'lawyer', 'trial', 'verdict', 'contract', 'statute',
+        'appeal', 'evidence', 'witness', 'jury', 'defendant', 'plaintiff',
+        'regulation', 'law', 'rights', 'settlement', 'lawsuit', 'legislation', 'case'
+    ],
+    'education': [
+        'student', 'teacher', 'school', 'university', 'classroom', 'exam', 'lesson',
+        'curriculum', 'degree', 'lecture', 'homework', 'research', 'professor',
+        'grade', 'campus', 'library', 'course', 'learning', 'scholarship', 'study'
+    ],
+    'travel': [
+        'flight', 'hotel', 'airport', 'passport', 'tourist', 'beach', 'luggage',
+        'journey', 'destination', 'ticket', 'museum', 'island', 'cruise', 'train',
+        'booking', 'guide', 'resort', 'mountain', 'city', 'holiday'
+    ],
+}
+
+# Shared filler words, including stopwords, so preprocessing has real work to do
+FILLER_WORDS = [
+    'the', 'a', 'of', 'and', 'to', 'in', 'is', 'was', 'for', 'on', 'with', 'that',
+    'this', 'by', 'are', 'were', 'new', 'report', 'year', 'people', 'time',
+    'group', 'week', 'number', 'recent', 'local', 'major', 'announced', 'said',
+    'during', 'after', 'before', 'across', 'several', 'growing', 'running'
+]
+
+SEARCH_QUERIES = [
+    'stock market earnings',
+    'hospital patient treatment',
+    'football championship season',
+    'cloud software security',
+    'climate change and carbon emissions',
+    'court ruling on contract appeal',
+    'university students exams',
+    'cheap flights and hotels',
+]
+
+# Calls traced for memory per stage without RSS tracking, and the smallest
+# growth that counts as a regression
+MEMORY_SAMPLE_CALLS = 20
+MEMORY_NOISE_MB = 1.0
+
+
+def generate_corpus(num_docs: int, words_per_doc: int = 200, seed: int = 42) -> List[str]:
+    """Generate synthetic documents drawn from a handful of topic vocabularies"""
+    rng = random.Random(seed)
+    topics = list(TOPIC_VOCABULARIES.values())
+    corpus = []
+
+    for i in range(num_docs):
+        vocabulary = topics[i % len(topics)]
+        words = []
+        for _ in range(words_per_doc):
+            # Roughly 60% topic words, 40% filler
+            if rng.random() < 0.6:
+                words.append(rng.choice(vocabulary))
+            else:
+                words.append(rng.choice(FILLER_WORDS))
+        # Break into sentences of about 12 words
+        sentences = [
+            ' '.join(words[j:j + 12]).capitalize() + '.'
+            for j in range(0, len(words), 12)
+        ]
+        corpus.append(' '.join(sentences))
+
+    return corpus
+
+
+def write_corpus_files(corpus: List[str], directory: Path) -> List[Path]:
+    """Write the corpus to disk, alternating between .txt and .docx files"""
+    directory.mkdir(parents=True, exist_ok=True)
+    paths = []
+
+    for i, text in enumerate(corpus):
+        if i % 2 == 0:
+            path = directory / f"doc_{i}.txt"
+            with open(path, 'w', encoding='utf-8') as f:
+                f.write(text)
+        else:
+            path = directory / f"doc_{i}.docx"
+            doc = Document()
+            doc.add_heading(f"Document {i}", level=1)
+            doc.add_paragraph(text)
+            doc.save(path)
+        paths.append(path)
+
+    return paths
+
+
+def peak_rss_mb() -> Optional[float]:
+    """Peak resident set size of this process so far, in megabytes"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is reported in bytes on macOS and kilobytes on Linux
+    if sys.platform == 'darwin':
+        return round(peak / (1024 * 1024), 2)
+    # Per-stage measurement resets the high-water mark ru_maxrss is read from
+    return round(max(peak / 1024, _peak_before_reset_mb), 2)
+
+
+def _status_mb(field: str) -> float:
+    """A memory field of /proc/self/status, in megabytes"""
+    with open('/proc/self/status', 'r') as f:
+        for line in f:
+            if line.startswith(f"{field}:"):
+                return int(line.split()[1]) / 1024  # Reported in kB
+    raise OSError(f"{field} missing from /proc/self/status")
+
+
+# Highest RSS high-water mark seen before a reset, for the whole-process peak
+_peak_before_reset_mb = 0.0
+
+
+def reset_peak_rss() -> bool:
+    """Reset this process's RSS high-water mark; False where that is unsupported"""
+    global _peak_before_reset_mb
+    try:
+        _peak_before_reset_mb = max(_peak_before_reset_mb, _status_mb('VmHWM'))
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+# Whether stages are measured by RSS (Linux) rather than tracemalloc
+RSS_TRACKING = reset_peak_rss()
+
+
+def run_calls(fn: Callable, args_list: List[tuple], setup: Optional[Callable] = None,
+              memory: Optional[str] = None) -> Tuple[List[float], Optional[float]]:
+    """
+    Call fn once per argument tuple; setup runs untimed before every call
+    Args:
+        memory: 'rss' or 'tracemalloc' to measure peak memory growth over
+            the memory in use before the first call, so memory retained by
+            earlier calls counts too; None skips memory measurement
+    Returns: Per-call latencies in seconds and the peak growth in megabytes
+    """
+    latencies = []
+    peak = 0.0
+    if memory == 'tracemalloc':
+        tracemalloc.start()
+    try:
+        if memory == 'rss':
+            baseline = _status_mb('VmRSS')
+        elif memory == 'tracemalloc':
+            baseline = tracemalloc.get_traced_memory()[0] / (1024 * 1024)
+        for args in args_list:
+            if setup is not None:
+                setup()
+            if memory == 'rss':
+                reset_peak_rss()
+            elif memory == 'tracemalloc':
+                tracemalloc.reset_peak()
+            start = time.perf_counter()
+            fn(*args)
+            latencies.append(time.perf_counter() - start)
+            if memory == 'rss':
+                peak = max(peak, _status_mb('VmHWM') - baseline)
+            elif memory == 'tracemalloc':
+                peak = max(peak, tracemalloc.get_traced_memory()[1] / (1024 * 1024) - baseline)
+    finally:
+        if memory == 'tracemalloc':
+            tracemalloc.stop()
+    return latencies, round(peak, 2) if memory is not None else None
+
+
+def summarize(latencies: List[float], items: int,
+              peak_mem_mb: Optional[float] = None) -> Dict[str, Any]:
+    """Summarize a list of per-call latencies (seconds) into a stage result"""
+    latencies_ms = np.array(latencies) * 1000
+    total = float(sum(latencies))
+    return {
+        'calls': len(latencies),
+        'items': items,
+        'total_s': round(total, 4),
+        'p50_ms': round(float(np.percentile(latencies_ms, 50)), 3),
+        'p95_ms': round(float(np.percentile(latencies_ms, 95)), 3),
+        'throughput_per_s': round(items / total, 2) if total > 0 else None,
+        'peak_mem_mb': peak_mem_mb,
+    }
+
+
+def time_calls(fn: Callable, args_list: List[tuple], items_per_call: int = 1,
+               setup: Optional[Callable] = None) -> Dict[str, Any]:
+    """
+    Call fn once per argument tuple, timing each call
+    setup runs untimed before every call to restore the starting state.
+    Without RSS tracking, the first few calls are repeated beforehand with
+    tracemalloc on, so tracing does not skew the timings
+    """
+    if RSS_TRACKING:
+        latencies, peak_mem_mb = run_calls(fn, args_list, setup, memory='rss')
+    else:
+        _, peak_mem_mb = run_calls(fn, args_list[:MEMORY_SAMPLE_CALLS], setup, memory='tracemalloc')
+        latencies, _ = run_calls(fn, args_list, setup)
+    return summarize(latencies, len(args_list) * items_per_call, peak_mem_mb)
+
+
+def isolate_app_state(app_module, work_dir: Path):
+    """Point the app's global state at a scratch directory so real data is untouched"""
+    from data_store import document_store
+    from clustering import document_clusterer
+    from shared_state import SharedState
+    from similarity_graph import similarity_graph
+
+    data_dir = work_dir / "data"
+    upload_dir = work_dir / "uploads"
+    models_dir = work_dir / "models"
+    for directory in (data_dir, upload_dir, models_dir):
+        directory.mkdir(parents=True, exist_ok=True)
+
+    state = SharedState(data_dir)
+    searcher = app_module.semantic_searcher
+
+    document_store.state = state
+    document_store.data_dir = data_dir
+    document_store.data_file = data_dir / "document_store.json"
+    document_store.load_data()
+    document_clusterer.state = state
+    document_clusterer.model = None
+    document_clusterer.model_path = models_dir / "kmeans_model.joblib"
+    document_clusterer.index_path = models_dir / "cluster_index.json"
+    document_clusterer.load_index()
+    searcher.state = state
+    searcher.data_dir = data_dir
+    searcher.index_file = data_dir / "embedding_index.json"
+    searcher.load_index()
+    similarity_graph.state = state
+    similarity_graph.data_dir = data_dir
+    similarity_graph.graph_file = data_dir / "similarity_graph.npz"
+    similarity_graph.load_graph()
+    app_module.UPLOAD_DIR = str(upload_dir)
+
+
+def benchmark_stages(corpus: List[str], work_dir: Path, num_clusters: int,
+                     repeat: int, num_queries: int,
+                     nprobes: List[int]) -> Dict[str, Dict[str, Any]]:
+    """Time each hot path directly, bypassing the HTTP layer"""
+    import main as app_module
+    from preprocessing import preprocess_text, tokens_to_string
+    from vectorization import document_vectorizer
+    from clustering import document_clusterer
+
+    isolate_app_state(app_module, work_dir)
+    results = {}
+
+    print(f"Writing {len(corpus)} synthetic files...")
+    paths = write_corpus_files(corpus, work_dir / "corpus")
+
+    print("Timing extract_text...")
+    results['extract_text'] = time_calls(app_module.extract_text, [(str(p),) for p in paths])
+
+    print("Timing preprocess_text...")
+    results['preprocess_text'] = time_calls(preprocess_text, [(text,) for text in corpus])
+    processed_texts = [tokens_to_string(preprocess_text(text)) for text in corpus]
+
+    print("Timing fit_transform_documents...")
+    results['fit_transform_documents'] = time_calls(
+        document_vectorizer.fit_transform_documents,
+        [(processed_texts,)] * repeat,
+        items_per_call=len(processed_texts)
+    )
+    vectors = document_vectorizer.get_vectors()
+
+    print("Timing cluster_documents...")
+    doc_ids = [f"doc_{i}" for i in range(len(processed_texts))]
+    results['cluster_documents'] = time_calls(
+        document_clusterer.cluster_documents,
+        [(vectors, num_clusters, doc_ids)] * repeat,
+        items_per_call=vectors.shape[0]
+    )
+
+    print("Timing SemanticSearch.embed_documents...")
+    documents = {
+        doc_id: {'preprocessed_text': text}
+        for doc_id, text in zip(doc_ids, processed_texts)
+    }
+    searcher = app_module.semantic_searcher
+    # Embedding is incremental, so start every call from an empty index
+    results['embed_documents'] = time_calls(
+        searcher.embed_documents, [(documents,)], items_per_call=len(documents),
+        setup=searcher.clear
+    )
+
+    print("Timing SemanticSearch.search...")
+    queries = [SEARCH_QUERIES[i % len(SEARCH_QUERIES)] for i in range(num_queries)]
+    results['search'] = time_calls(searcher.search, [(q,) for q in queries])
+
+    print("Timing SimilarityGraph.build...")
+    from similarity_graph import similarity_graph
+    results['similarity_graph_build'] = time_calls(
+        similarity_graph.build,
+        [(searcher.doc_ids, searcher.embeddings)],
+        items_per_call=len(searcher.doc_ids)
+    )
+
+    # Cluster-pruned search: latency and recall@10 against the full scan
+    exact = {q: {doc_id for doc_id, _ in searcher.search(q)} for q in set(queries)}
+    for nprobe in nprobes:
+        print(f"Timing SemanticSearch.search with nprobe={nprobe}...")
+        stage = f'search_nprobe_{nprobe}'
+        results[stage] = time_calls(searcher.search, [(q, 10, nprobe) for q in queries])
+        recall = [
+            len(exact[q] & {doc_id for doc_id, _ in searcher.search(q, 10, nprobe)}) / max(len(exact[q]), 1)
+            for q in exact
+        ]
+        results[stage]['recall_at_10'] = round(float(np.mean(recall)), 4)
+
+    return results
+
+
+def benchmark_api(corpus: List[str], work_dir: Path, num_clusters: int,
+                  batch_size: int, num_queries: int) -> Dict[str, Dict[str, Any]]:
+    """Time the end-to-end API through FastAPI's test client"""
+    from fastapi.testclient import TestClient
+    import main as app_module
+
+    isolate_app_state(app_module, work_dir)
+    client = TestClient(app_module.app)
+    results = {}
+
+    def request(method: str, url: str, **kwargs):
+        client.request(method, url, **kwargs).raise_for_status()
+
+    def timed_request(method: str, url: str, **kwargs) -> Tuple[float, Optional[float]]:
+        """Time one request, measuring its peak RSS growth as well where supported"""
+        latencies, peak_mem_mb = run_calls(
+            lambda: request(method, url, **kwargs), [()], memory='rss' if RSS_TRACKING else None
+        )
+        return latencies[0], peak_mem_mb
+
+    def traced_request(method: str, url: str, **kwargs) -> float:
+        """Repeat a request with tracemalloc on, outside the timed runs"""
+        return run_calls(lambda: request(method, url, **kwargs), [()], memory='tracemalloc')[1]
+
+    print(f"Timing POST /upload ({len(corpus)} docs, batches of {batch_size})...")
+    latencies, peaks = [], []
+    for start in range(0, len(corpus), batch_size):
+        files = [
+            ('files', (f"api_doc_{start + i}.txt", text.encode('utf-8'), 'text/plain'))
+            for i, text in enumerate(corpus[start:start + batch_size])
+        ]
+        latency, peak_mem_mb = timed_request('POST', '/upload', files=files)
+        latencies.append(latency)
+        peaks.append(peak_mem_mb)
+    stored_docs = len(corpus)
+    if RSS_TRACKING:
+        peak_mem_mb = max(peaks)
+    else:
+        # Uploads are not repeatable, so trace one extra batch of fresh copies
+        extra_files = [
+            ('files', (f"api_extra_{i}.txt", text.encode('utf-8'), 'text/plain'))
+            for i, text in enumerate(corpus[:batch_size])
+        ]
+        peak_mem_mb = traced_request('POST', '/upload', files=extra_files)
+        stored_docs += len(extra_files)
+    results['api_upload'] = summarize(latencies, len(corpus), peak_mem_mb)
+
+    print("Timing POST /cluster...")
+    cluster_params = {'num_clusters': num_clusters}
+    latency, peak_mem_mb = timed_request('POST', '/cluster', params=cluster_params)
+    if not RSS_TRACKING:
+        peak_mem_mb = traced_request('POST', '/cluster', params=cluster_params)
+    results['api_cluster'] = summarize([latency], stored_docs, peak_mem_mb)
+
+    print("Timing POST /semantic-search...")
+    latencies, peaks = [], []
+    for i in range(num_queries):
+        latency, peak_mem_mb = timed_request(
+            'POST', '/semantic-search', json={'query': SEARCH_QUERIES[i % len(SEARCH_QUERIES)]}
+        )
+        latencies.append(latency)
+        peaks.append(peak_mem_mb)
+    if RSS_TRACKING:
+        peak_mem_mb = max(peaks)
+    else:
+        peak_mem_mb = traced_request('POST', '/semantic-search', json={'query': SEARCH_QUERIES[0]})
+    results['api_semantic_search'] = summarize(latencies, num_queries, peak_mem_mb)
+
+    print("Timing GET /tsne...")
+    latency, peak_mem_mb = timed_request('GET', '/tsne')
+    if not RSS_TRACKING:
+        peak_mem_mb = traced_request('GET', '/tsne')
+    results['api_tsne'] = summarize([latency], stored_docs, peak_mem_mb)
+
+    return results
+
+
+def compare_results(baseline: Dict[str, Any], current: Dict[str, Any],
+                    tolerance: float = 0.10) -> List[str]:
+    """
+    Compare two benchmark runs
+    Returns: A list of human-readable regressions beyond the given tolerance
+    """
+    regressions = []
+    for stage, current_stats in current.get('stages', {}).items():
+        baseline_stats = baseline.get('stages', {}).get(stage)
+        if baseline_stats is None:
+            continue
+
+        for key in ('p50_ms', 'p95_ms'):
+            old, new = baseline_stats.get(key), current_stats.get(key)
+            if old and new and new > old * (1 + tolerance):
+                regressions.append(f"{stage}.{key}: {old} -> {new} (+{(new / old - 1) * 100:.1f}%)")
+
+        old, new = baseline_stats.get('throughput_per_s'), current_stats.get('throughput_per_s')
+        if old and new and new < old * (1 - tolerance):
+            regressions.append(f"{stage}.throughput_per_s: {old} -> {new} (-{(1 - new / old) * 100:.1f}%)")
+
+        # Small absolute changes are allocator noise, whatever their relative size
+        old, new = baseline_stats.get('peak_mem_mb'), current_stats.get('peak_mem_mb')
+        if old is not None and new is not None and new > old * (1 + tolerance) \
+                and new - old >= MEMORY_NOISE_MB:
+            regressions.append(f"{stage}.peak_mem_mb: {old} -> {new} (+{new - old:.1f} MB)")
+
+    return regressions
+
+
+def run_benchmark(args: argparse.Namespace) -> Dict[str, Any]:
+    """Run the selected benchmark suites and collect their results"""
+    corpus = generate_corpus(args.docs, args.words_per_doc, args.seed)
+    stages = {}
+
+    with tempfile.TemporaryDirectory(prefix="sdc-bench-") as tmp:
+        work_dir = Path(tmp)
+        if not args.skip_stages:
+            stages.update(benchmark_stages(
+                corpus, work_dir / "stages", args.clusters, args.repeat, args.queries,
+                args.nprobe
+            ))
+        if not args.skip_api:
+            api_corpus = corpus[:args.api_docs]
+            stages.update(benchmark_api(
+                api_corpus, work_dir / "api", args.clusters, args.api_batch, args.queries
+            ))
+
+    return {
+        'meta': {
+            'timestamp': datetime.now().isoformat(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'docs': args.docs,
+            'api_docs': min(args.api_docs, args.docs),
+            'words_per_doc': args.words_per_doc,
+            'clusters': args.clusters,
+            'seed': args.seed,
+            # Whole-process peak, dominated by model loading; per-stage memory is peak_mem_mb
+            'process_peak_rss_mb': peak_rss_mb(),
+            'stage_memory': 'rss' if RSS_TRACKING else 'tracemalloc',
+        },
+        'stages': stages,
+    }
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Benchmark ingestion, clustering and search")
+    parser.add_argument('--docs', type=int, default=1000, help="Synthetic corpus size (1k-200k)")
+    parser.add_argument('--words-per-doc', type=int, default=200)
+    parser.add_argument('--clusters', type=int, default=8)
+    parser.add_argument('--repeat', type=int, default=3, help="Runs of each batch stage")
+    parser.add_argument('--queries', type=int, default=50, help="Search queries to time")
+    parser.add_argument('--nprobe', type=int, nargs='*', default=[1, 2],
+                        help="Cluster-pruned search settings to time")
+    parser.add_argument('--api-docs', type=int, default=200,
+                        help="Documents pushed through the API")
+    parser.add_argument('--api-batch', type=int, default=20, help="Files per /upload request")
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--skip-stages', action='store_true')
+    parser.add_argument('--skip-api', action='store_true')
+    parser.add_argument('--output', type=Path, help="Write results JSON to this file")
+    parser.add_argument('--compare', type=Path, help="Baseline results JSON to compare against")
+    parser.add_argument('--tolerance', type=float, default=0.10,
+                        help="Relative slowdown or memory growth that counts as a regression")
+    return parser.parse_args(argv)
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    args = parse_args(argv)
+    results = run_benchmark(args)
+    output = json.dumps(results, indent=2)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+        print(f"Results written to {args.output}")
+    else:
+        print(output)
+
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            baseline = json.load(f)
+        regressions = compare_results(baseline, results, args.tolerance)
+        if regressions:
+            print("Regressions detected:")
+            for regression in regressions:
+                print(f"  {regression}")
+            return 1
+        print("No regressions detected")
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -3,24 +3,78 @@ from sklearn.preprocessing import normalize
 from scipy.sparse import spmatrix
 import numpy as np
 import joblib
+import json
 from pathlib import Path
+from typing import Dict, Iterable, List, Optional
+import metrics
+from shared_state import SharedState, shared_state, atomic_write, atomic_write_json
+
+class ModelNotTrainedError(ValueError):
+    """Raised when clustering is needed before any model has been trained"""
+
 
 class DocumentClusterer:
-    def __init__(self):
+    def __init__(self, models_dir: Optional[Path] = None, state: Optional[SharedState] = None):
         self.model = None
-        self.model_path = Path(__file__).parent / "models" / "kmeans_model.joblib"
+        self.model_path = Path(models_dir or Path(__file__).parent / "models") / "kmeans_model.joblib"
+        self.state = state or shared_state
+        self.version = None  # Shared version of the model currently loaded
+        # Inverted list used to route searches: cluster -> member doc_ids
+        self.index_path = self.model_path.parent / "cluster_index.json"
+        self.cluster_members: Dict[int, List[str]] = {}
+        self.index_version = None
+        self._centroids = None
+        self._centroids_model = None
         # Create models directory if it doesn't exist
         self.model_path.parent.mkdir(exist_ok=True)
         
     def reset(self):
         """Reset the clusterer state and remove saved model"""
-        self.model = None
-        if self.model_path.exists():
-            self.model_path.unlink()
+        with self.state.write_lock():
+            self.model = None
+            if self.model_path.exists():
+                self.model_path.unlink()
+            self.version = self.state.bump_version('kmeans')
+            self._save_index({})
             
-    def cluster_documents(self, doc_vectors: spmatrix, num_clusters: int = 4) -> tuple[np.ndarray, KMeans]:
+    def load_model(self) -> KMeans:
+        """Load the trained model, reloading if another worker has retrained or reset it"""
+        version = self.state.get_version('kmeans')
+        if self.model is None or version != self.version:
+            try:
+                self.model = joblib.load(self.model_path)
+                self.version = version
+            except FileNotFoundError:
+                self.model = None
+                raise ModelNotTrainedError("No trained clustering model found")
+        return self.model
+
+    def load_index(self):
+        """Load the cluster -> doc_ids inverted list"""
+        self.index_version = self.state.get_version('cluster_index')
+        try:
+            with open(self.index_path, 'r') as f:
+                members = json.load(f)
+            self.cluster_members = {int(cluster): ids for cluster, ids in members.items()}
+        except FileNotFoundError:
+            self.cluster_members = {}
+
+    def refresh_index(self):
+        """Reload the inverted list if another worker has changed it"""
+        if self.state.get_version('cluster_index') != self.index_version:
+            self.load_index()
+
+    def _save_index(self, cluster_members: Dict[int, List[str]]):
+        """Persist the inverted list; call while holding the write lock"""
+        atomic_write_json(self.index_path, {str(c): ids for c, ids in cluster_members.items()})
+        self.cluster_members = cluster_members
+        self.index_version = self.state.bump_version('cluster_index')
+
+    def cluster_documents(self, doc_vectors: spmatrix, num_clusters: int = 4,
+                          doc_ids: Optional[List[str]] = None) -> tuple[np.ndarray, KMeans]:
         """
         Cluster document vectors using K-means with enhanced parameters
+        If doc_ids are given, the cluster -> doc_ids inverted list is rebuilt
         """
         self.model = KMeans(
             n_clusters=num_clusters,
@@ -32,22 +86,80 @@ class DocumentClusterer:
         )
         # Normalize the vectors before clustering
         normalized_vectors = normalize(doc_vectors, norm='l2', axis=1)
-        labels = self.model.fit_predict(normalized_vectors)
+        with metrics.timer('clustering', items=normalized_vectors.shape[0]):
+            labels = self.model.fit_predict(normalized_vectors)
         
-        # Save the trained model
-        joblib.dump(self.model, self.model_path)
+        # Save the trained model and publish it to other workers
+        with self.state.write_lock():
+            with metrics.timer('model_save'):
+                atomic_write(self.model_path, lambda f: joblib.dump(self.model, f))
+            self.version = self.state.bump_version('kmeans')
+            # Without doc_ids the old inverted list no longer matches the model
+            cluster_members = {}
+            if doc_ids is not None:
+                cluster_members = {cluster: [] for cluster in range(num_clusters)}
+                for doc_id, label in zip(doc_ids, labels):
+                    cluster_members[int(label)].append(doc_id)
+            self._save_index(cluster_members)
         
         return labels, self.model
     
-    def predict_cluster(self, doc_vector: spmatrix) -> int:
-        """Predict cluster for a new document vector"""
-        if self.model is None:
-            try:
-                self.model = joblib.load(self.model_path)
-            except FileNotFoundError:
-                raise ValueError("No trained clustering model found")
-        
-        return self.model.predict(doc_vector)[0]
+    def predict_cluster(self, doc_vector: spmatrix, doc_id: Optional[str] = None) -> int:
+        """
+        Predict cluster for a new document vector
+        If doc_id is given, the document is added to that cluster's inverted list
+        """
+        if doc_id is not None:
+            return int(self.assign_documents([doc_id], doc_vector)[0])
+        model = self.load_model()
+        # Vectors were normalized before fitting, so normalize the same way here
+        with metrics.timer('cluster_assignment', items=1):
+            return model.predict(normalize(doc_vector, norm='l2', axis=1))[0]
+
+    def assign_documents(self, doc_ids: List[str], doc_vectors: spmatrix) -> np.ndarray:
+        """Predict clusters for new documents and add them to the inverted list"""
+        model = self.load_model()
+        with metrics.timer('cluster_assignment', items=len(doc_ids)):
+            labels = model.predict(normalize(doc_vectors, norm='l2', axis=1))
+        with self.state.write_lock():
+            self.refresh_index()
+            cluster_members = {c: list(ids) for c, ids in self.cluster_members.items()}
+            assigned = set(doc_ids)
+            for cluster in cluster_members:
+                cluster_members[cluster] = [d for d in cluster_members[cluster] if d not in assigned]
+            for doc_id, label in zip(doc_ids, labels):
+                cluster_members.setdefault(int(label), []).append(doc_id)
+            self._save_index(cluster_members)
+        return labels
+
+    def remove_documents(self, doc_ids: Iterable[str]):
+        """Remove documents from the inverted list"""
+        doc_ids = set(doc_ids)
+        with self.state.write_lock():
+            self.refresh_index()
+            if not any(d in doc_ids for ids in self.cluster_members.values() for d in ids):
+                return
+            self._save_index({
+                cluster: [d for d in ids if d not in doc_ids]
+                for cluster, ids in self.cluster_members.items()
+            })
+
+    def get_centroids(self) -> np.ndarray:
+        """Unit-length cluster centroids, one row per cluster"""
+        model = self.load_model()
+        if self._centroids_model is not model:
+            self._centroids = normalize(model.cluster_centers_, norm='l2', axis=1)
+            self._centroids_model = model
+        return self._centroids
+
+    def probe_clusters(self, query_embedding: np.ndarray, nprobe: int) -> List[int]:
+        """Return the nprobe clusters whose centroids are most similar to the query"""
+        if nprobe < 1:
+            raise ValueError("nprobe must be at least 1")
+        scores = self.get_centroids() @ np.asarray(query_embedding, dtype=np.float32)
+        nprobe = min(nprobe, len(scores))
+        top = np.argpartition(-scores, nprobe - 1)[:nprobe]
+        return [int(c) for c in top[np.argsort(-scores[top])]]
 
 # Global instance
 document_clusterer = DocumentClusterer()
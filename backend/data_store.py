@@ -1,75 +1,131 @@
-from typing import Dict, Any, List
+from typing import Dict, Any, List, Optional, Tuple
 from datetime import datetime
 import json
 from pathlib import Path
+import metrics
+from shared_state import SharedState, shared_state, atomic_write_json
 
 class DocumentStore:
-    def __init__(self):
+    def __init__(self, data_dir: Optional[Path] = None, state: Optional[SharedState] = None):
         self.documents: Dict[str, Dict[str, Any]] = {}
-        self.data_dir = Path(__file__).parent / "data"
+        self.data_dir = Path(data_dir) if data_dir else Path(__file__).parent / "data"
         self.data_file = self.data_dir / "document_store.json"
-        
+        self.state = state or shared_state
+        self.version = None  # Shared version of the data currently in memory
+
         # Create data directory if it doesn't exist
         self.data_dir.mkdir(exist_ok=True)
-        
+
         # Load existing data if available
         self.load_data()
-        
+
     def load_data(self):
         """Load document data from JSON file"""
+        # Read the version first so a concurrent write triggers another reload
+        self.version = self.state.get_version('documents')
         try:
             if self.data_file.exists():
-                with open(self.data_file, 'r') as f:
-                    self.documents = json.load(f)
+                with metrics.timer('store_load'):
+                    with open(self.data_file, 'r') as f:
+                        self.documents = json.load(f)
+                # Vectors now live in the shared embedding index; drop legacy copies
+                for doc in self.documents.values():
+                    doc.pop('vector', None)
+            else:
+                self.documents = {}
         except Exception as e:
             print(f"Error loading data: {e}")
+            metrics.record_error('store_load')
             self.documents = {}
-            
+
+    def refresh(self):
+        """Reload documents if another worker has changed them"""
+        if self.state.get_version('documents') != self.version:
+            self.load_data()
+
     def save_data(self):
-        """Save document data to JSON file"""
+        """Save document data to JSON file and publish the new version"""
         try:
-            with open(self.data_file, 'w') as f:
-                json.dump(self.documents, f, indent=2)
+            with self.state.write_lock():
+                with metrics.timer('store_save', items=len(self.documents)):
+                    atomic_write_json(self.data_file, self.documents, indent=2)
+                self.version = self.state.bump_version('documents')
         except Exception as e:
             print(f"Error saving data: {e}")
-            
-    def store_document(self, filename: str, file_type: str, extracted_text: str):
-        """Store a document with its metadata and content"""
+            metrics.record_error('store_save')
+
+    def new_document(self, filename: str, file_type: str, extracted_text: str,
+                     **kwargs) -> Tuple[str, Dict[str, Any]]:
+        """Build a document record and its ID without storing it"""
         doc_id = f"{filename}_{datetime.now().timestamp()}"
-        self.documents[doc_id] = {
+        doc = {
             'filename': filename,
             'file_type': file_type,
             'extracted_text': extracted_text,
             'upload_timestamp': datetime.now().isoformat(),
             'preprocessed_text': None,  # Will be populated after preprocessing
-            'vector': None,  # Will be populated after vectorization
             'cluster': None  # Will be populated after clustering
         }
-        self.save_data()
+        doc.update(kwargs)
+        return doc_id, doc
+
+    def add_documents(self, documents: Dict[str, Dict[str, Any]]):
+        """Store several documents with a single write"""
+        if not documents:
+            return
+        with self.state.write_lock():
+            self.refresh()
+            self.documents.update(documents)
+            self.save_data()
+
+    def store_document(self, filename: str, file_type: str, extracted_text: str):
+        """Store a document with its metadata and content"""
+        doc_id, doc = self.new_document(filename, file_type, extracted_text)
+        self.add_documents({doc_id: doc})
         return doc_id
-        
+
     def get_document(self, doc_id: str) -> Dict[str, Any]:
         """Retrieve a document by its ID"""
+        self.refresh()
         return self.documents.get(doc_id)
 
+    def has_document(self, doc_id: str) -> bool:
+        """Check whether a document is currently in the store"""
+        self.refresh()
+        return doc_id in self.documents
+
     def clear_all(self):
         """Clear all documents and remove the data file"""
-        self.documents = {}
-        if self.data_file.exists():
-            self.data_file.unlink()
-            
+        with self.state.write_lock():
+            self.documents = {}
+            if self.data_file.exists():
+                self.data_file.unlink()
+            self.version = self.state.bump_version('documents')
+
     def get_all_documents(self) -> Dict[str, Dict[str, Any]]:
         """Get all stored documents"""
+        self.refresh()
         return self.documents
-        
+
     def update_document(self, doc_id: str, **kwargs):
         """Update document attributes"""
-        if doc_id in self.documents:
-            self.documents[doc_id].update(kwargs)
-            self.save_data()
-            
+        self.update_documents({doc_id: kwargs})
+
+    def update_documents(self, updates: Dict[str, Dict[str, Any]]):
+        """Update attributes of several documents with a single write"""
+        with self.state.write_lock():
+            self.refresh()
+            changed = False
+            for doc_id, attributes in updates.items():
+                if doc_id in self.documents:
+                    self.documents[doc_id].update(attributes)
+                    changed = True
+            if changed:
+                self.save_data()
+
     def get_cluster_documents(self) -> Dict[int, List[Dict[str, str]]]:
         """Get documents grouped by their cluster"""
+        self.refresh()
         cluster_docs = {}
         for doc_id, doc in self.documents.items():
             cluster = doc.get('cluster')
@@ -85,9 +141,11 @@ class DocumentStore:
 
     def delete_document(self, doc_id: str) -> None:
         """Delete a document from the store"""
-        if doc_id in self.documents:
-            del self.documents[doc_id]
-            self.save_data()
+        with self.state.write_lock():
+            self.refresh()
+            if doc_id in self.documents:
+                del self.documents[doc_id]
+                self.save_data()
 
 # Global instance to be used across the application
 document_store = DocumentStore()
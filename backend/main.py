@@ -1,20 +1,23 @@
-from typing import Union, List
+from typing import Union, List, Optional
 import os
-from fastapi import FastAPI, UploadFile, File, Body
-from fastapi.responses import JSONResponse
+from fastapi import FastAPI, UploadFile, File, Body, Query, Request
+from fastapi.responses import JSONResponse, PlainTextResponse
 from fastapi.middleware.cors import CORSMiddleware
+from starlette.routing import Match
 import aiofiles
 from pdfminer.high_level import extract_text as extract_pdf_text
 from docx import Document
 import shutil
 from data_store import document_store
 from preprocessing import preprocess_text, tokens_to_string
-from vectorization import document_vectorizer
 from clustering import document_clusterer
 from semantic_search import SemanticSearch
+from similarity_graph import similarity_graph
 from sklearn.manifold import TSNE
 from models import TSNEResult
 import numpy as np
+import time
+import metrics
 
 app = FastAPI()
 
@@ -27,6 +30,30 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+def route_template(request: Request) -> str:
+    """Resolve the route path template (e.g. /document/{doc_id}) to keep label cardinality low"""
+    for route in app.router.routes:
+        match, _ = route.matches(request.scope)
+        if match == Match.FULL:
+            return route.path
+    return "unmatched"
+
+@app.middleware("http")
+async def record_request_metrics(request: Request, call_next):
+    """Record latency and status of every request"""
+    if not metrics.registry.enabled:
+        return await call_next(request)
+    start = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        metrics.observe_request(
+            request.method, route_template(request), status, time.perf_counter() - start
+        )
+
 # Create uploads directory if it doesn't exist
 UPLOAD_DIR = os.path.join(os.path.dirname(__file__), "uploads")
 os.makedirs(UPLOAD_DIR, exist_ok=True)
@@ -39,6 +66,7 @@ async def save_uploaded_file(upload_file: UploadFile) -> str:
         await out_file.write(content)
     return file_path
 
+@metrics.timed('extraction')
 def extract_text(file_path: str) -> str:
     """Extract text from different file types"""
     _, ext = os.path.splitext(file_path.lower())
@@ -90,12 +118,14 @@ def extract_text(file_path: str) -> str:
         else:
             return f"Unsupported file type: {ext}"
     except Exception as e:
+        metrics.record_error('extraction')
         return f"Error extracting text: {str(e)}"
 
 @app.post("/upload")
 async def upload_files(files: List[UploadFile] = File(...)):
     """Handle multiple file uploads and extract text"""
     results = []
+    new_documents = {}
     
     for file in files:
         # Validate file type
@@ -116,22 +146,18 @@ async def upload_files(files: List[UploadFile] = File(...)):
             # Extract text
             extracted_text = extract_text(file_path)
             
-            # Store document
-            doc_id = document_store.store_document(
-                filename=file.filename,
-                file_type=file_ext,
-                extracted_text=extracted_text
-            )
-            
             # Preprocess text
             tokens = preprocess_text(extracted_text)
             processed_text = tokens_to_string(tokens)
             
-            # Update document with preprocessed text
-            document_store.update_document(
-                doc_id,
+            # Build the document; the whole batch is stored at once below
+            doc_id, doc = document_store.new_document(
+                filename=file.filename,
+                file_type=file_ext,
+                extracted_text=extracted_text,
                 preprocessed_text=processed_text
             )
+            new_documents[doc_id] = doc
             
             # Add to results
             results.append({
@@ -146,24 +172,25 @@ async def upload_files(files: List[UploadFile] = File(...)):
                 "error": str(e)
             })
     
-    # After processing all documents, update vectors
-    all_docs = document_store.get_all_documents()
-    processed_texts = [
-        doc['preprocessed_text']
-        for doc in all_docs.values()
-        if doc['preprocessed_text'] is not None
-    ]
-    
-    if processed_texts:
-        # Generate TF-IDF vectors
-        vectors = document_vectorizer.fit_transform_documents(processed_texts)
+    if new_documents:
+        # Add the new documents to the shared embedding index (their vectors live there)
+        semantic_searcher.embed_documents(new_documents)
         
-        # Update documents with their vectors
-        for (doc_id, doc), vector in zip(all_docs.items(), vectors):
-            document_store.update_document(
-                doc_id,
-                vector=vector.toarray()[0].tolist()
-            )
+        # Assign new uploads to the existing clusters so cluster-pruned search sees them
+        new_ids, vectors = semantic_searcher.get_embeddings(list(new_documents))
+        if new_ids:
+            try:
+                labels = document_clusterer.assign_documents(new_ids, vectors)
+                for doc_id, label in zip(new_ids, labels):
+                    new_documents[doc_id]['cluster'] = int(label)
+            except ValueError:
+                pass  # No clustering model trained yet
+        
+        # Store the whole batch with a single write
+        document_store.add_documents(new_documents)
+        
+        # Fold new uploads into the similarity graph
+        update_similarity_graph()
     
     return JSONResponse(content={
         "status": "success",
@@ -185,17 +212,23 @@ async def perform_clustering(num_clusters: int = 5):
             content={"message": "No documents available for clustering"}
         )
     
-    # Get preprocessed texts and perform vectorization
-    doc_ids = list(docs.keys())
-    preprocessed_texts = [doc["preprocessed_text"] for doc in docs.values()]
-    vectors = document_vectorizer.fit_transform_documents(preprocessed_texts)
+    # Cluster the vectors in the shared embedding index, embedding any documents missing from it
+    embed_stored_documents(docs)
+    doc_ids, vectors = semantic_searcher.get_embeddings(list(docs))
+    if len(doc_ids) < num_clusters:
+        return JSONResponse(
+            status_code=400,
+            content={"message": f"Need at least {num_clusters} documents with text to create {num_clusters} clusters"}
+        )
     
     # Perform clustering
-    labels, model = document_clusterer.cluster_documents(vectors, num_clusters)
+    labels, model = document_clusterer.cluster_documents(vectors, num_clusters, doc_ids)
     
-    # Update document store with cluster labels
-    for doc_id, label in zip(doc_ids, labels):
-        document_store.update_document(doc_id, cluster=int(label))
+    # Update document store with cluster labels in a single write
+    document_store.update_documents({
+        doc_id: {'cluster': int(label)}
+        for doc_id, label in zip(doc_ids, labels)
+    })
     
     # Count documents per cluster
     unique_labels, counts = np.unique(labels, return_counts=True)
@@ -256,13 +289,15 @@ async def get_document(doc_id: str):
 async def list_documents():
     """List all documents and their preprocessing status"""
     docs = document_store.get_all_documents()
+    # Stores written before the shared embedding index have no embeddings yet
+    embed_stored_documents(docs)
     return {
         "total_documents": len(docs),
         "documents": [
             {
                 "doc_id": doc_id,
                 "filename": doc["filename"],
-                "status": "processed" if doc.get("vector") is not None else "pending"
+                "status": "processed" if doc_id in semantic_searcher.row_index else "pending"
             }
             for doc_id, doc in docs.items()
         ]
@@ -294,8 +329,9 @@ async def delete_document(doc_id: str):
         document_store.delete_document(doc_id)
         
         # Remove from semantic search embeddings
-        if hasattr(semantic_searcher, 'document_embeddings') and doc_id in semantic_searcher.document_embeddings:
-            del semantic_searcher.document_embeddings[doc_id]
+        semantic_searcher.remove_documents([doc_id])
+        document_clusterer.remove_documents([doc_id])
+        update_similarity_graph()
         
         return {"status": "success", "message": f"Document {doc_id} deleted"}
     except Exception as e:
@@ -307,12 +343,20 @@ async def delete_document(doc_id: str):
 # Create semantic search instance
 semantic_searcher = SemanticSearch()
 
+def embed_stored_documents(docs):
+    """Embed store documents missing from the index, skipping any deleted in the meantime"""
+    semantic_searcher.embed_documents(docs, still_exists=document_store.has_document)
+
 @app.post("/semantic-search")
-async def perform_semantic_search(query: str = Body(..., embed=True)):
+async def perform_semantic_search(
+    query: str = Body(..., embed=True),
+    nprobe: Optional[int] = Body(None, embed=True, ge=1)
+):
     """
     Perform semantic search across documents
     Args:
         query: Search query string
+        nprobe: Only search the nprobe clusters nearest to the query (default: all documents)
     Returns:
         List of documents with similarity scores
     """
@@ -325,10 +369,10 @@ async def perform_semantic_search(query: str = Body(..., embed=True)):
         )
     
     # Update embeddings
-    semantic_searcher.embed_documents(docs)
+    embed_stored_documents(docs)
     
     # Perform search
-    results = semantic_searcher.search(query)
+    results = semantic_searcher.search(query, nprobe=nprobe)
     
     # Format results
     formatted_results = []
@@ -371,11 +415,10 @@ async def clear_all():
         document_store.clear_all()
         
         # Clear semantic search embeddings
-        if hasattr(semantic_searcher, 'document_embeddings'):
-            semantic_searcher.document_embeddings.clear()
+        semantic_searcher.clear()
+        similarity_graph.clear()
         
-        # Reset document vectorizer and clusterer
-        document_vectorizer.reset()
+        # Reset document clusterer
         document_clusterer.reset()
 
         return {
@@ -400,22 +443,18 @@ async def get_tsne_projection():
     if len(docs) < 2:
         return []
     
-    # Extract document vectors and metadata
-    doc_vectors = []
-    doc_ids = []
-    doc_clusters = []
+    # Read vectors of clustered documents from the shared embedding index,
+    # embedding any documents missing from it
+    embed_stored_documents(docs)
+    clustered = [doc_id for doc_id, doc in docs.items() if doc.get('cluster') is not None]
+    embedded, vectors = semantic_searcher.get_embeddings(clustered)
     
-    for doc_id, doc in docs.items():
-        if doc.get('vector') is not None and doc.get('cluster') is not None:
-            doc_vectors.append(doc['vector'])
-            doc_ids.append(doc['filename'])  # Using filename as ID
-            doc_clusters.append(doc['cluster'])
-    
-    if len(doc_vectors) < 2:
+    if len(embedded) < 2:
         return []
-        
-    # Convert to numpy array
-    vectors = np.array(doc_vectors)
+    
+    # Extract document metadata
+    doc_ids = [docs[doc_id]['filename'] for doc_id in embedded]  # Using filename as ID
+    doc_clusters = [docs[doc_id]['cluster'] for doc_id in embedded]
     
     # Perform t-SNE
     tsne = TSNE(
@@ -423,7 +462,8 @@ async def get_tsne_projection():
         random_state=42,
         perplexity=min(30, len(vectors) - 1)
     )
-    projected = tsne.fit_transform(vectors)
+    with metrics.timer('projection', items=len(vectors)):
+        projected = tsne.fit_transform(vectors)
     
     # Create result objects
     results = []
@@ -435,4 +475,134 @@ async def get_tsne_projection():
             id=doc_ids[i]
         ))
     
-    return results
\ No newline at end of file
+    return results
+
+@app.on_event("startup")
+async def start_metrics_exporter():
+    """Publish this worker's metrics so /metrics on any worker covers all of them"""
+    metrics.exporter.start()
+
+@app.on_event("shutdown")
+async def stop_metrics_exporter():
+    metrics.exporter.stop()
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics():
+    """Expose stage and request metrics, totalled across workers, in the Prometheus text format"""
+    return PlainTextResponse(
+        metrics.render_metrics(),
+        media_type="text/plain; version=0.0.4"
+    )
+
+@app.post("/profiler/start")
+async def start_profiler(interval: float = Query(0.01, ge=0.001)):
+    """
+    Start the sampling profiler in every worker
+    Args:
+        interval: Seconds between stack samples (default: 0.01, minimum: 0.001)
+    """
+    metrics.exporter.set_profiler(running=True, interval=interval)
+    return {"status": "running", "interval": metrics.profiler.interval}
+
+@app.post("/profiler/stop")
+async def stop_profiler():
+    """Stop the sampling profiler in every worker, keeping collected samples"""
+    metrics.exporter.set_profiler(running=False)
+    return {"status": "stopped"}
+
+@app.get("/profiler", response_class=PlainTextResponse)
+async def get_profile(reset: bool = False):
+    """
+    Get samples collected across workers as collapsed stacks (flamegraph input)
+    Args:
+        reset: Clear samples in every worker after reading them
+    """
+    report = metrics.profile_report()
+    if reset:
+        metrics.exporter.set_profiler(reset=True)
+    return PlainTextResponse(report)
+
+
+def update_similarity_graph():
+    """
+    Embed any new documents and bring the similarity graph in line with the index
+    Failures are logged rather than raised; the graph catches up on the next update
+    """
+    try:
+        embed_stored_documents(document_store.get_all_documents())
+        similarity_graph.update(semantic_searcher.current_index)
+    except Exception as e:
+        print(f"Error updating similarity graph: {e}")
+        metrics.record_error('similarity_graph')
+
+@app.post("/similarity-graph/build")
+async def build_similarity_graph():
+    """Rebuild the k-nearest-neighbour graph over all document embeddings"""
+    docs = document_store.get_all_documents()
+    if not docs:
+        return JSONResponse(
+            status_code=400,
+            content={"message": "No documents available for the similarity graph"}
+        )
+    
+    embed_stored_documents(docs)
+    similarity_graph.build(semantic_searcher.doc_ids, semantic_searcher.embeddings)
+    
+    return {
+        "message": "Similarity graph built",
+        "num_documents": len(similarity_graph.doc_ids),
+        "k": similarity_graph.k
+    }
+
+@app.get("/duplicates")
+async def get_duplicates(threshold: float = Query(0.95, ge=-1, le=1)):
+    """
+    Get groups of near-duplicate documents from the similarity graph
+    Args:
+        threshold: Minimum cosine similarity for two documents to count as duplicates
+    """
+    docs = document_store.get_all_documents()
+    groups = []
+    for group in similarity_graph.duplicate_groups(threshold):
+        documents = [
+            {"doc_id": doc_id, "filename": docs[doc_id]["filename"]}
+            for doc_id in group
+            if doc_id in docs
+        ]
+        if len(documents) > 1:
+            groups.append({"size": len(documents), "documents": documents})
+    
+    return {
+        "threshold": threshold,
+        "num_groups": len(groups),
+        "groups": groups
+    }
+
+@app.get("/document/{doc_id}/similar")
+async def get_similar_documents(doc_id: str, top_k: int = Query(10, ge=1)):
+    """
+    Get the documents most similar to a document from the similarity graph
+    Args:
+        top_k: Number of similar documents to return (at most the graph's k)
+    """
+    docs = document_store.get_all_documents()
+    if doc_id not in docs:
+        return JSONResponse(
+            status_code=404,
+            content={"error": "Document not found"}
+        )
+    
+    results = []
+    for similar_id, similarity in similarity_graph.similar(doc_id, top_k):
+        doc = docs.get(similar_id)
+        if doc:
+            results.append({
+                "doc_id": similar_id,
+                "filename": doc["filename"],
+                "similarity": similarity
+            })
+    
+    return {
+        "doc_id": doc_id,
+        "results": results
+    }
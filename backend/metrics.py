@@ -0,0 +1,481 @@
+"""
+Lightweight instrumentation: counters, histograms and a sampling profiler.
+
+Metrics are exposed in the Prometheus text format. Set METRICS_ENABLED=0 to
+turn recording into a no-op, and PROFILER_ENABLED=1 to start the sampling
+profiler at import time.
+
+Each worker process records its own values; when several uvicorn workers
+run, WorkerExporter publishes per-worker snapshots under data/metrics so
+any worker can render totals across all of them.
+"""
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from collections import Counter as StackCounter
+from contextlib import contextmanager
+from functools import wraps
+from pathlib import Path
+import bisect
+import json
+import os
+import sys
+import threading
+import time
+from shared_state import shared_state, atomic_write_json
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+LabelKey = Tuple[Tuple[str, str], ...]
+
+
+def _label_key(labels: Dict[str, str]) -> LabelKey:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(key: LabelKey, extra: Optional[Tuple[str, str]] = None) -> str:
+    pairs = list(key) + ([extra] if extra else [])
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{k}="{_escape(v)}"' for k, v in pairs) + '}'
+
+
+class Counter:
+    def __init__(self, name: str, documentation: str):
+        self.name = name
+        self.documentation = documentation
+        self.values: Dict[LabelKey, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1.0, **labels):
+        """Increment the counter for the given label set"""
+        key = _label_key(labels)
+        with self._lock:
+            self.values[key] = self.values.get(key, 0.0) + amount
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            values = [[list(map(list, key)), value] for key, value in self.values.items()]
+        return {'type': 'counter', 'documentation': self.documentation, 'values': values}
+
+    def merge(self, snapshot: Dict[str, Any]):
+        """Add the values of another process's snapshot"""
+        for key, value in snapshot['values']:
+            key = tuple(map(tuple, key))
+            with self._lock:
+                self.values[key] = self.values.get(key, 0.0) + value
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in sorted(self.values.items()):
+                lines.append(f"{self.name}{_format_labels(key)} {value}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, documentation: str, buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = tuple(sorted(buckets))
+        # label key -> [per-bucket counts..., +Inf count], sum
+        self.counts: Dict[LabelKey, List[int]] = {}
+        self.sums: Dict[LabelKey, float] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        """Record a single observation for the given label set"""
+        key = _label_key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self.counts.get(key)
+            if counts is None:
+                counts = self.counts[key] = [0] * (len(self.buckets) + 1)
+                self.sums[key] = 0.0
+            counts[index] += 1
+            self.sums[key] += value
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            values = [
+                [list(map(list, key)), list(counts), self.sums[key]]
+                for key, counts in self.counts.items()
+            ]
+        return {
+            'type': 'histogram',
+            'documentation': self.documentation,
+            'buckets': list(self.buckets),
+            'values': values
+        }
+
+    def merge(self, snapshot: Dict[str, Any]):
+        """Add the observations of another process's snapshot"""
+        if tuple(snapshot['buckets']) != self.buckets:
+            return  # Recorded by a different version of the code
+        for key, counts, total in snapshot['values']:
+            key = tuple(map(tuple, key))
+            with self._lock:
+                current = self.counts.setdefault(key, [0] * (len(self.buckets) + 1))
+                for i, count in enumerate(counts):
+                    current[i] += count
+                self.sums[key] = self.sums.get(key, 0.0) + total
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key in sorted(self.counts):
+                cumulative = 0
+                for bound, count in zip(self.buckets + (float('inf'),), self.counts[key]):
+                    cumulative += count
+                    le = '+Inf' if bound == float('inf') else repr(bound)
+                    lines.append(f"{self.name}_bucket{_format_labels(key, ('le', le))} {cumulative}")
+                lines.append(f"{self.name}_sum{_format_labels(key)} {self.sums[key]}")
+                lines.append(f"{self.name}_count{_format_labels(key)} {cumulative}")
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self, enabled: bool = True):
+        self.enabled = enabled
+        self.metrics: Dict[str, object] = {}
+
+    def counter(self, name: str, documentation: str) -> Counter:
+        """Get or create a counter"""
+        if name not in self.metrics:
+            self.metrics[name] = Counter(name, documentation)
+        return self.metrics[name]
+
+    def histogram(self, name: str, documentation: str,
+                  buckets: Tuple[float, ...] = DEFAULT_BUCKETS) -> Histogram:
+        """Get or create a histogram"""
+        if name not in self.metrics:
+            self.metrics[name] = Histogram(name, documentation, buckets)
+        return self.metrics[name]
+
+    def snapshot(self) -> Dict[str, Dict[str, Any]]:
+        """JSON-serializable copy of every metric's values"""
+        return {name: metric.snapshot() for name, metric in self.metrics.items()}
+
+    def merged(self, snapshots: List[Dict[str, Dict[str, Any]]]) -> 'MetricsRegistry':
+        """A new registry holding this registry's values plus those of the given snapshots"""
+        combined = MetricsRegistry(self.enabled)
+        for snapshot in [self.snapshot()] + snapshots:
+            for name, data in snapshot.items():
+                if data['type'] == 'counter':
+                    combined.counter(name, data['documentation']).merge(data)
+                else:
+                    combined.histogram(name, data['documentation'], tuple(data['buckets'])).merge(data)
+        return combined
+
+    def render(self) -> str:
+        """Render all metrics in the Prometheus text exposition format"""
+        lines = []
+        for metric in self.metrics.values():
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+    def reset(self):
+        """Drop all recorded values, keeping metric definitions"""
+        for metric in self.metrics.values():
+            with metric._lock:
+                for attr in ('values', 'counts', 'sums'):
+                    if hasattr(metric, attr):
+                        getattr(metric, attr).clear()
+
+
+class SamplingProfiler:
+    """
+    Periodically samples the stacks of all threads and aggregates them
+    into collapsed-stack counts (compatible with flamegraph tooling)
+    """
+    def __init__(self, interval: float = 0.01, max_depth: int = 64):
+        self.interval = interval
+        self.max_depth = max_depth
+        self.samples: StackCounter = StackCounter()
+        self._thread: Optional[threading.Thread] = None
+        self._stop_event = threading.Event()
+        self._lock = threading.Lock()
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, interval: Optional[float] = None):
+        """Start sampling in a background thread"""
+        if interval is not None and interval <= 0:
+            # Event.wait(0) returns immediately, so the sampler would spin on a core
+            raise ValueError("Profiler interval must be positive")
+        if self.running:
+            return
+        if interval is not None:
+            self.interval = interval
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop sampling; collected samples are kept until reset"""
+        if not self.running:
+            return
+        self._stop_event.set()
+        self._thread.join()
+        self._thread = None
+
+    def reset(self):
+        with self._lock:
+            self.samples.clear()
+
+    def _run(self):
+        own_id = threading.get_ident()
+        while not self._stop_event.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = []
+                while frame is not None and len(stack) < self.max_depth:
+                    code = frame.f_code
+                    stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                    frame = frame.f_back
+                with self._lock:
+                    self.samples[';'.join(reversed(stack))] += 1
+
+    def snapshot(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self.samples)
+
+    def report(self, snapshots: Optional[List[Dict[str, int]]] = None) -> str:
+        """
+        Return collected samples as collapsed stacks, most frequent first
+        Samples from the given snapshots (other workers) are added in
+        """
+        with self._lock:
+            samples = StackCounter(self.samples)
+        for snapshot in snapshots or []:
+            samples.update(snapshot)
+        return '\n'.join(f"{stack} {count}" for stack, count in samples.most_common()) + '\n'
+
+
+class WorkerExporter:
+    """
+    Shares this worker's metrics and profile with the other worker processes.
+    Each worker rewrites a snapshot file every flush_interval seconds, and
+    rendering merges the snapshots of every live worker. The profiler on/off
+    switch lives in a shared control file, so toggling it through any worker
+    reaches all of them within one flush interval.
+    """
+    def __init__(self, directory: Path, flush_interval: float = 5.0, stale_after: float = 30.0):
+        self.directory = Path(directory)
+        self.flush_interval = flush_interval
+        self.stale_after = stale_after  # Snapshots older than this belong to dead workers
+        self.path = self.directory / f"worker-{os.getpid()}-{time.time_ns()}.json"
+        self.control_path = self.directory / "profiler.json"
+        self._profile_generation = None
+        self._thread: Optional[threading.Thread] = None
+        self._stop_event = threading.Event()
+
+    def start(self):
+        """Start publishing snapshots in a background thread"""
+        if self._thread is not None:
+            return
+        self.directory.mkdir(parents=True, exist_ok=True)
+        with shared_state.write_lock():
+            if not self.peer_snapshots():
+                # First worker of this server run: a control file left behind by
+                # an earlier run must not override PROFILER_ENABLED
+                atomic_write_json(self.control_path, {
+                    'running': profiler.running,
+                    'interval': profiler.interval,
+                    'generation': 0
+                })
+            # Announce this worker before releasing the lock so the workers
+            # starting next adopt the control file instead of reseeding it
+            self.flush()
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, name="metrics-exporter", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop publishing and withdraw this worker's snapshot"""
+        if self._thread is None:
+            return
+        self._stop_event.set()
+        self._thread.join()
+        self._thread = None
+        try:
+            self.path.unlink()
+        except OSError:
+            pass
+
+    def _run(self):
+        while True:
+            try:
+                self.sync_profiler()
+                self.flush()
+            except Exception as e:
+                print(f"Error exporting metrics: {e}")
+            if self._stop_event.wait(self.flush_interval):
+                return
+
+    def flush(self):
+        """Publish this worker's current metrics and profile samples"""
+        atomic_write_json(self.path, {
+            'pid': os.getpid(),
+            'metrics': registry.snapshot(),
+            'profile': profiler.snapshot()
+        })
+
+    def peer_snapshots(self) -> List[Dict[str, Any]]:
+        """Latest snapshots published by the other live workers"""
+        snapshots = []
+        now = time.time()
+        for path in self.directory.glob("worker-*.json"):
+            if path == self.path:
+                continue
+            try:
+                if now - path.stat().st_mtime > self.stale_after:
+                    path.unlink()
+                    continue
+                with open(path, 'r') as f:
+                    snapshots.append(json.load(f))
+            except (OSError, ValueError):
+                continue  # Removed or replaced while reading
+        return snapshots
+
+    def read_control(self) -> Dict[str, Any]:
+        try:
+            with open(self.control_path, 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def set_profiler(self, running: Optional[bool] = None, interval: Optional[float] = None,
+                     reset: bool = False):
+        """Change the profiler state for every worker"""
+        if interval is not None and interval <= 0:
+            raise ValueError("Profiler interval must be positive")
+        self.directory.mkdir(parents=True, exist_ok=True)
+        with shared_state.write_lock():
+            control = self.read_control()
+            control.setdefault('running', profiler.running)
+            control.setdefault('interval', profiler.interval)
+            control.setdefault('generation', 0)
+            if running is not None:
+                control['running'] = running
+            if interval is not None:
+                control['interval'] = interval
+            if reset:
+                control['generation'] += 1
+            atomic_write_json(self.control_path, control)
+        self.sync_profiler()
+
+    def sync_profiler(self):
+        """Apply the shared profiler state to this worker"""
+        control = self.read_control()
+        if not control:
+            return
+        profiler.interval = control['interval']
+        if control['running'] and not profiler.running:
+            profiler.start()
+        elif not control['running'] and profiler.running:
+            profiler.stop()
+        if control['generation'] != self._profile_generation:
+            if self._profile_generation is not None:
+                profiler.reset()
+            self._profile_generation = control['generation']
+
+
+# Global instances
+registry = MetricsRegistry(enabled=os.getenv("METRICS_ENABLED", "1") != "0")
+profiler = SamplingProfiler()
+exporter = WorkerExporter(Path(__file__).parent / "data" / "metrics")
+
+stage_duration = registry.histogram(
+    "smartdoc_stage_duration_seconds", "Time spent in each processing stage"
+)
+stage_errors = registry.counter(
+    "smartdoc_stage_errors_total", "Errors raised or swallowed per processing stage"
+)
+stage_items = registry.counter(
+    "smartdoc_stage_items_total", "Documents or queries handled per processing stage"
+)
+request_duration = registry.histogram(
+    "smartdoc_http_request_duration_seconds", "HTTP request latency"
+)
+requests_total = registry.counter(
+    "smartdoc_http_requests_total", "HTTP requests by method, route and status"
+)
+
+
+@contextmanager
+def _stage_timer(stage: str, items: int):
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        stage_errors.inc(stage=stage)
+        raise
+    finally:
+        stage_duration.observe(time.perf_counter() - start, stage=stage)
+        if items:
+            stage_items.inc(items, stage=stage)
+
+
+@contextmanager
+def _null_timer():
+    yield
+
+
+def timer(stage: str, items: int = 0):
+    """Context manager timing a block as the given stage"""
+    if not registry.enabled:
+        return _null_timer()
+    return _stage_timer(stage, items)
+
+
+def timed(stage: str) -> Callable:
+    """Decorator timing every call of the wrapped function as the given stage"""
+    def decorator(fn: Callable) -> Callable:
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not registry.enabled:
+                return fn(*args, **kwargs)
+            with _stage_timer(stage, 0):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def count_items(stage: str, items: int):
+    """Record how many documents or queries a stage handled"""
+    if registry.enabled:
+        stage_items.inc(items, stage=stage)
+
+
+def record_error(stage: str):
+    """Record an error that was handled without raising"""
+    if registry.enabled:
+        stage_errors.inc(stage=stage)
+
+
+def observe_request(method: str, route: str, status: int, duration: float):
+    """Record a completed HTTP request"""
+    if registry.enabled:
+        request_duration.observe(duration, method=method, route=route)
+        requests_total.inc(method=method, route=route, status=status)
+
+
+def render_metrics() -> str:
+    """Render metrics totalled across all live workers"""
+    peers = [snapshot['metrics'] for snapshot in exporter.peer_snapshots()]
+    return registry.merged(peers).render()
+
+
+def profile_report() -> str:
+    """Collapsed stacks sampled across all live workers"""
+    return profiler.report([snapshot['profile'] for snapshot in exporter.peer_snapshots()])
+
+
+if os.getenv("PROFILER_ENABLED", "0") == "1":
+    profiler.start()
@@ -5,6 +5,7 @@ from nltk.corpus import stopwords
 from nltk.stem import WordNetLemmatizer
 import string
 from nltk_setup import ensure_nltk_resources
+import metrics
 
 # Ensure NLTK resources are available
 ensure_nltk_resources()
@@ -14,6 +15,7 @@ tokenizer = RegexpTokenizer(r'\w+')  # This will split on non-word characters
 lemmatizer = WordNetLemmatizer()
 stop_words = set(stopwords.words('english'))
 
+@metrics.timed('preprocessing')
 def preprocess_text(text: str) -> List[str]:
     """
     Preprocess text by:
@@ -43,6 +45,7 @@ def preprocess_text(text: str) -> List[str]:
         
     except Exception as e:
         print(f"Error in preprocessing: {str(e)}")
+        metrics.record_error('preprocessing')
         return []
 
 def tokens_to_string(tokens: List[str]) -> str:
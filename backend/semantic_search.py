@@ -1,55 +1,308 @@
 from sentence_transformers import SentenceTransformer
 from sklearn.metrics.pairwise import cosine_similarity
 import numpy as np
-from typing import List, Dict
+from typing import Callable, List, Dict, Iterable, Optional, Tuple
+from pathlib import Path
+import json
+import os
+import uuid
+import metrics
+from shared_state import SharedState, shared_state, atomic_write, atomic_write_json
+from clustering import DocumentClusterer, document_clusterer, ModelNotTrainedError
+
+MIN_CAPACITY = 1024  # Rows preallocated for a new embedding matrix
+
+
+def _encode_ids(doc_ids: List[str]) -> bytes:
+    """One JSON string per line, so IDs can be appended to the file"""
+    return ''.join(json.dumps(doc_id) + '\n' for doc_id in doc_ids).encode('utf-8')
+
 
 class SemanticSearch:
-    def __init__(self):
+    def __init__(self, data_dir: Optional[Path] = None, state: Optional[SharedState] = None,
+                 clusterer: Optional[DocumentClusterer] = None):
         self.model = SentenceTransformer('all-MiniLM-L6-v2')  # Small, fast, good quality model
-        self.document_embeddings = {}  # doc_id -> embedding
-        
-    def embed_documents(self, documents: Dict[str, dict]):
+        self.data_dir = Path(data_dir) if data_dir else Path(__file__).parent / "data"
+        self.index_file = self.data_dir / "embedding_index.json"
+        self.state = state or shared_state
+        self.version = None  # Shared version of the index currently loaded
+        self.doc_ids: List[str] = []
+        self.embeddings: Optional[np.ndarray] = None  # Memory-mapped, rows aligned with doc_ids
+        self.row_index: Dict[str, int] = {}  # doc_id -> row in embeddings
+        self.clusterer = clusterer or document_clusterer
+        # Append-only files backing the loaded view; the matrix is preallocated
+        # beyond the live rows so uploads append in place
+        self._index: Optional[dict] = None
+        self._matrix: Optional[np.ndarray] = None
+        # Cluster -> embedding rows, rebuilt when the index or the clusters change
+        self._cluster_rows: Dict[int, np.ndarray] = {}
+        self._unassigned_rows = np.empty(0, dtype=np.intp)
+        self._routing_key = None
+        self.data_dir.mkdir(exist_ok=True)
+        self.load_index()
+
+    def load_index(self):
+        """Memory-map the embedding matrix published by the last writer"""
+        for _ in range(3):
+            self.version = self.state.get_version('embeddings')
+            try:
+                with open(self.index_file, 'r') as f:
+                    index = json.load(f)
+            except FileNotFoundError:
+                self._index, self._matrix = None, None
+                self.doc_ids, self.embeddings, self.row_index = [], None, {}
+                return
+            try:
+                self._load_view(index)
+                return
+            except FileNotFoundError:
+                # The files were replaced between reading the index and opening them
+                continue
+        raise RuntimeError("Embedding index changed too often while loading")
+
+    def _load_view(self, index: dict):
+        if self._index is not None and index['matrix'] == self._index['matrix']:
+            # Same files as before: only read the IDs appended since the last load
+            matrix, offset = self._matrix, self._index['ids_size']
+            doc_ids, row_index = list(self.doc_ids), dict(self.row_index)
+        else:
+            matrix, offset = np.load(self.data_dir / index['matrix'], mmap_mode='r'), 0
+            doc_ids, row_index = [], {}
+        if index['ids_size'] > offset:
+            with open(self.data_dir / index['ids'], 'rb') as f:
+                f.seek(offset)
+                appended = f.read(index['ids_size'] - offset).decode('utf-8').splitlines()
+            for doc_id in map(json.loads, appended):
+                row_index[doc_id] = len(doc_ids)
+                doc_ids.append(doc_id)
+        self._index, self._matrix = index, matrix
+        self.doc_ids, self.embeddings, self.row_index = doc_ids, matrix[:index['rows']], row_index
+
+    def refresh(self):
+        """Reload the index if another worker has published a new one"""
+        if self.state.get_version('embeddings') != self.version:
+            self.load_index()
+
+    def _write_index(self, index: Optional[dict]):
+        """Publish an index and load it; call while holding the write lock"""
+        if index is not None:
+            atomic_write_json(self.index_file, index)
+        elif self.index_file.exists():
+            self.index_file.unlink()
+        self.state.bump_version('embeddings')
+        self.load_index()
+
+    def _replace(self, doc_ids: List[str], embeddings: Optional[np.ndarray]):
+        """Write the whole index to new files; call while holding the write lock"""
+        old_index = self._index
+        if doc_ids:
+            name = f"embeddings_{uuid.uuid4().hex}"
+            capacity = max(MIN_CAPACITY, 2 * len(doc_ids))  # Room for later appends
+            matrix = np.lib.format.open_memmap(
+                self.data_dir / f"{name}.npy", mode='w+',
+                dtype=np.float32, shape=(capacity, embeddings.shape[1])
+            )
+            matrix[:len(doc_ids)] = embeddings
+            matrix.flush()
+            del matrix
+            ids = _encode_ids(doc_ids)
+            atomic_write(self.data_dir / f"{name}.ids", lambda f: f.write(ids))
+            self._write_index({
+                'matrix': f"{name}.npy", 'ids': f"{name}.ids",
+                'rows': len(doc_ids), 'ids_size': len(ids)
+            })
+        else:
+            self._write_index(None)
+
+        # Workers that still map the old matrix keep their view until they refresh
+        if old_index is not None:
+            for name in (old_index['matrix'], old_index['ids']):
+                try:
+                    (self.data_dir / name).unlink()
+                except OSError:
+                    pass
+
+    def _append(self, doc_ids: List[str], embeddings: np.ndarray):
+        """
+        Append rows in place, past the rows readers can see, then publish the
+        new row count; call while holding the write lock
+        """
+        index = self._index
+        rows = len(self.doc_ids)
+        if index is None or rows + len(doc_ids) > self._matrix.shape[0]:
+            # Out of room: copy into files twice the size, amortized over many appends
+            parts = [np.asarray(self.embeddings)] if rows else []
+            self._replace(self.doc_ids + doc_ids, np.vstack(parts + [embeddings]))
+            return
+
+        matrix = np.load(self.data_dir / index['matrix'], mmap_mode='r+')
+        matrix[rows:rows + len(doc_ids)] = embeddings
+        matrix.flush()
+        del matrix
+        ids = _encode_ids(doc_ids)
+        with open(self.data_dir / index['ids'], 'r+b') as f:
+            # Overwrite anything past the published size left by an interrupted append
+            f.seek(index['ids_size'])
+            f.write(ids)
+            f.truncate()
+            f.flush()
+            os.fsync(f.fileno())
+        self._write_index(dict(index, rows=rows + len(doc_ids), ids_size=index['ids_size'] + len(ids)))
+
+    def embed_documents(self, documents: Dict[str, dict],
+                        still_exists: Optional[Callable[[str], bool]] = None):
         """
-        Generate embeddings for all documents
+        Generate embeddings for documents missing from the index
+        Embeddings are only dropped through remove_documents/clear, so
+        documents embedded before they reach the store are not lost to a
+        concurrent call from another worker
+        Args:
+            still_exists: Checked under the write lock before publishing, so
+                documents deleted while they were being encoded are not re-added
         """
+        self.refresh()
+        indexed = set(self.doc_ids)
         doc_ids = []
         texts = []
-        
+
         for doc_id, doc in documents.items():
+            if doc_id in indexed:
+                continue
             # Use preprocessed text if available, otherwise use extracted text
             text = doc.get('preprocessed_text') or doc.get('extracted_text')
             if text:
                 doc_ids.append(doc_id)
                 texts.append(text)
-        
-        if texts:
-            # Generate embeddings for all texts at once
-            embeddings = self.model.encode(texts, normalize_embeddings=True)
-            
-            # Store embeddings with their doc_ids
-            for doc_id, embedding in zip(doc_ids, embeddings):
-                self.document_embeddings[doc_id] = embedding
-                
-    def search(self, query: str, top_k: int = 10) -> List[dict]:
+
+        if not texts:
+            return
+
+        # Encode outside the lock so other workers are not blocked meanwhile
+        with metrics.timer('encoding', items=len(texts)):
+            new_embeddings = self.model.encode(texts, normalize_embeddings=True).astype(np.float32)
+
+        with self.state.write_lock():
+            # Another worker may have updated the index while we were encoding
+            self.refresh()
+            add = [
+                i for i, doc_id in enumerate(doc_ids)
+                if doc_id not in self.row_index and (still_exists is None or still_exists(doc_id))
+            ]
+            if not add:
+                return
+            self._append([doc_ids[i] for i in add], new_embeddings[add])
+
+    def current_index(self) -> Tuple[List[str], Optional[np.ndarray]]:
+        """The latest published doc_ids and their embedding rows"""
+        self.refresh()
+        return self.doc_ids, self.embeddings
+
+    def get_embeddings(self, doc_ids: List[str]) -> Tuple[List[str], np.ndarray]:
+        """
+        Embeddings of the given documents, in order
+        Returns: The doc_ids present in the index and one embedding row per ID
+        """
+        self.refresh()
+        present = [doc_id for doc_id in doc_ids if doc_id in self.row_index]
+        if not present:
+            return [], np.empty((0, 0), dtype=np.float32)
+        return present, np.asarray(self.embeddings[[self.row_index[d] for d in present]])
+
+    def remove_documents(self, doc_ids: Iterable[str]):
+        """Remove documents from the embedding index"""
+        doc_ids = set(doc_ids)
+        with self.state.write_lock():
+            self.refresh()
+            keep = [i for i, doc_id in enumerate(self.doc_ids) if doc_id not in doc_ids]
+            if len(keep) == len(self.doc_ids):
+                return
+            merged_ids = [self.doc_ids[i] for i in keep]
+            self._replace(merged_ids, np.asarray(self.embeddings[keep]) if keep else None)
+
+    def clear(self):
+        """Remove all embeddings"""
+        with self.state.write_lock():
+            self.refresh()
+            self._replace([], None)
+
+    def _refresh_routing(self):
+        """Map each cluster's inverted list onto rows of the embedding matrix"""
+        self.clusterer.refresh_index()
+        key = (self.version, self.clusterer.index_version)
+        if key == self._routing_key:
+            return
+
+        assigned = np.zeros(len(self.doc_ids), dtype=bool)
+        cluster_rows = {}
+        for cluster, members in self.clusterer.cluster_members.items():
+            rows = [self.row_index[d] for d in members if d in self.row_index]
+            cluster_rows[cluster] = np.array(rows, dtype=np.intp)
+            assigned[cluster_rows[cluster]] = True
+
+        self._cluster_rows = cluster_rows
+        # Documents not yet assigned to a cluster are always searched
+        self._unassigned_rows = np.flatnonzero(~assigned)
+        self._routing_key = key
+
+    def _candidate_rows(self, query_embedding: np.ndarray, nprobe: int) -> Optional[np.ndarray]:
+        """
+        Rows of the nprobe clusters nearest to the query
+        Returns: None when routing is unavailable and the full index should be searched
+        """
+        try:
+            self._refresh_routing()
+            if not self._cluster_rows or nprobe >= len(self._cluster_rows):
+                return None
+            clusters = self.clusterer.probe_clusters(query_embedding, nprobe)
+        except ModelNotTrainedError:
+            return None
+        except ValueError as e:
+            # e.g. centroids from a model trained on vectors of another dimension
+            print(f"Error routing search to clusters, searching all documents: {e}")
+            metrics.record_error('search_routing')
+            return None
+
+        parts = [self._cluster_rows.get(c, np.empty(0, dtype=np.intp)) for c in clusters]
+        parts.append(self._unassigned_rows)
+        return np.concatenate(parts)
+
+    @metrics.timed('search')
+    def search(self, query: str, top_k: int = 10, nprobe: Optional[int] = None) -> List[Tuple[str, float]]:
         """
         Perform semantic search
+        Args:
+            nprobe: If set, only search documents in the nprobe clusters whose
+                centroids are nearest to the query; lower is faster, higher
+                recalls more. None searches every document.
         """
+        if nprobe is not None and nprobe < 1:
+            raise ValueError("nprobe must be at least 1")
+
         # Generate query embedding
         query_embedding = self.model.encode(query, normalize_embeddings=True)
-        
-        if not self.document_embeddings:
+
+        self.refresh()
+        if not self.doc_ids:
             return []
-            
-        # Stack all document embeddings
-        doc_embeddings = np.stack(list(self.document_embeddings.values()))
-        doc_ids = list(self.document_embeddings.keys())
-        
+
+        # Document embeddings are already stacked in the memory-mapped matrix
+        doc_embeddings = self.embeddings
+        doc_ids = self.doc_ids
+
+        rows = self._candidate_rows(query_embedding, nprobe) if nprobe is not None else None
+        if rows is not None:
+            metrics.count_items('search_pruned_candidates', len(rows))
+            if len(rows) == 0:
+                return []
+            doc_embeddings = doc_embeddings[rows]
+            doc_ids = [doc_ids[i] for i in rows]
+
         # Calculate similarities
         similarities = cosine_similarity([query_embedding], doc_embeddings)[0]
-        
+
         # Create list of (doc_id, similarity) pairs and sort by similarity
         doc_scores = list(zip(doc_ids, similarities))
         doc_scores.sort(key=lambda x: x[1], reverse=True)
-        
+
         # Return top k results
         return doc_scores[:top_k]
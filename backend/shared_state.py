@@ -0,0 +1,130 @@
+"""
+Coordination between worker processes that share the data directory.
+
+Writers take an exclusive file lock, write files atomically and bump a
+per-component version number. Readers compare the version they loaded
+against the current one and reload when it has changed, so every uvicorn
+worker sees the same documents, embeddings and clustering model.
+"""
+from typing import Callable, Dict
+from contextlib import contextmanager
+from pathlib import Path
+import json
+import os
+import tempfile
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+
+def _lock_file(f):
+    if fcntl is not None:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        return
+    f.seek(0)
+    while True:
+        try:
+            msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+            return
+        except OSError:
+            time.sleep(0.05)
+
+
+def _unlock_file(f):
+    if fcntl is not None:
+        fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+        return
+    f.seek(0)
+    msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+def atomic_write(path: Path, write: Callable):
+    """
+    Write a file atomically: write(f) fills a temporary file in the same
+    directory, which then replaces the target in a single rename
+    """
+    path = Path(path)
+    fd, tmp_path = tempfile.mkstemp(dir=path.parent, prefix=f".{path.name}.", suffix=".tmp")
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            write(f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+
+
+def atomic_write_json(path: Path, data, **kwargs):
+    """Serialize data as JSON and write it atomically"""
+    atomic_write(path, lambda f: f.write(json.dumps(data, **kwargs).encode('utf-8')))
+
+
+class SharedState:
+    def __init__(self, data_dir: Path):
+        self.data_dir = Path(data_dir)
+        self.data_dir.mkdir(parents=True, exist_ok=True)
+        self.lock_path = self.data_dir / "state.lock"
+        self.version_path = self.data_dir / "state_versions.json"
+
+        # Threads of this process serialize on the RLock; the file lock
+        # is taken once by the outermost holder and excludes other processes
+        self._thread_lock = threading.RLock()
+        self._depth = 0
+        self._lock_handle = None
+
+        # Last versions read successfully, used if a read fails
+        self._versions: Dict[str, int] = {}
+
+    @contextmanager
+    def write_lock(self):
+        """Exclusive lock across all workers; re-entrant within a process"""
+        with self._thread_lock:
+            if self._depth == 0:
+                self._lock_handle = open(self.lock_path, 'a+')
+                _lock_file(self._lock_handle)
+            self._depth += 1
+            try:
+                yield
+            finally:
+                self._depth -= 1
+                if self._depth == 0:
+                    _unlock_file(self._lock_handle)
+                    self._lock_handle.close()
+                    self._lock_handle = None
+
+    def _read_versions(self) -> Dict[str, int]:
+        # Always read the file: it is tiny, and a stat signature cannot tell
+        # apart two replacements that reuse an inode within one mtime tick
+        try:
+            with open(self.version_path, 'r') as f:
+                self._versions = json.load(f)
+        except FileNotFoundError:
+            self._versions = {}
+        except (OSError, ValueError):
+            # Fall back to the last good read; the next call retries
+            pass
+        return self._versions
+
+    def get_version(self, key: str) -> int:
+        """Current version of a component (0 if it was never written)"""
+        return self._read_versions().get(key, 0)
+
+    def bump_version(self, key: str) -> int:
+        """Increment a component's version; call while holding write_lock"""
+        with self.write_lock():
+            versions = dict(self._read_versions())
+            versions[key] = versions.get(key, 0) + 1
+            atomic_write_json(self.version_path, versions)
+            return versions[key]
+
+
+# Global instance shared by the data store, search index and clusterer
+shared_state = SharedState(Path(__file__).parent / "data")
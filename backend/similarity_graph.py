@@ -0,0 +1,259 @@
+from typing import Callable, Dict, List, Optional, Tuple
+from pathlib import Path
+import numpy as np
+import metrics
+from shared_state import SharedState, shared_state, atomic_write
+
+# Bytes held per similarity-matrix entry while a block is processed: float32
+# similarities plus the int64 index matrix from argpartition, or the boolean
+# mask used for reverse insertion, with headroom for NumPy temporaries
+BYTES_PER_ENTRY = 16
+
+class SimilarityGraph:
+    def __init__(self, k: int = 10, max_block_mb: float = 256,
+                 data_dir: Optional[Path] = None, state: Optional[SharedState] = None):
+        self.k = k
+        self.max_block_mb = max_block_mb  # Upper bound for the arrays held while processing one block
+        self.data_dir = Path(data_dir) if data_dir else Path(__file__).parent / "data"
+        self.graph_file = self.data_dir / "similarity_graph.npz"
+        self.state = state or shared_state
+        self.version = None  # Shared version of the graph currently loaded
+        self.doc_ids: List[str] = []
+        self.row_index: Dict[str, int] = {}
+        # Row i holds the k nearest neighbours of doc_ids[i], best first,
+        # padded with -1 / -inf when fewer than k other documents exist
+        self.neighbors = np.full((0, k), -1, dtype=np.int32)
+        self.scores = np.full((0, k), -np.inf, dtype=np.float32)
+        self.data_dir.mkdir(exist_ok=True)
+        self.load_graph()
+
+    def load_graph(self):
+        """Load the graph published by the last writer"""
+        self.version = self.state.get_version('similarity_graph')
+        try:
+            with np.load(self.graph_file) as data:
+                doc_ids = data['doc_ids'].tolist()
+                neighbors, scores = data['neighbors'], data['scores']
+        except FileNotFoundError:
+            doc_ids = []
+            neighbors = np.full((0, self.k), -1, dtype=np.int32)
+            scores = np.full((0, self.k), -np.inf, dtype=np.float32)
+        self._set(doc_ids, neighbors, scores)
+
+    def refresh(self):
+        """Reload the graph if another worker has changed it"""
+        if self.state.get_version('similarity_graph') != self.version:
+            self.load_graph()
+
+    def _set(self, doc_ids: List[str], neighbors: np.ndarray, scores: np.ndarray):
+        self.doc_ids = doc_ids
+        self.row_index = {doc_id: i for i, doc_id in enumerate(doc_ids)}
+        self.neighbors = neighbors
+        self.scores = scores
+
+    def _save(self):
+        """Persist the graph; call while holding the write lock"""
+        if self.doc_ids:
+            atomic_write(self.graph_file, lambda f: np.savez(
+                f,
+                doc_ids=np.array(self.doc_ids),
+                neighbors=self.neighbors,
+                scores=self.scores
+            ))
+        elif self.graph_file.exists():
+            self.graph_file.unlink()
+        self.version = self.state.bump_version('similarity_graph')
+
+    def _block_rows(self, num_docs: int) -> int:
+        """Rows per block so that the arrays held for one block stay within max_block_mb"""
+        budget = int(self.max_block_mb * 1024 * 1024)
+        return max(1, budget // (BYTES_PER_ENTRY * max(num_docs, 1)))
+
+    def _knn(self, rows: np.ndarray, embeddings: np.ndarray):
+        """
+        Yield (block_rows, similarities, neighbors, scores) for the given rows,
+        one bounded block of the similarity matrix at a time
+        """
+        matrix = np.asarray(embeddings, dtype=np.float32)  # No copy for the float32 index
+        num_docs = matrix.shape[0]
+        k = min(self.k, num_docs - 1)
+        block_size = self._block_rows(num_docs)
+
+        for start in range(0, len(rows), block_size):
+            block = rows[start:start + block_size]
+            sims = matrix[block] @ matrix.T
+            sims[np.arange(len(block)), block] = -np.inf  # A document is not its own neighbour
+
+            neighbors = np.full((len(block), self.k), -1, dtype=np.int32)
+            scores = np.full((len(block), self.k), -np.inf, dtype=np.float32)
+            if k > 0:
+                # Partition in place of a negated copy; copy the top k so the
+                # block-sized index matrix is freed straight away
+                top = np.argpartition(sims, -k, axis=1)[:, -k:].copy()
+                top_scores = np.take_along_axis(sims, top, axis=1)
+                order = np.argsort(-top_scores, axis=1)
+                neighbors[:, :k] = np.take_along_axis(top, order, axis=1)
+                scores[:, :k] = np.take_along_axis(top_scores, order, axis=1)
+            yield block, sims, neighbors, scores
+
+    def _build_arrays(self, embeddings: np.ndarray, num_docs: int) -> Tuple[np.ndarray, np.ndarray]:
+        """Compute neighbour and score arrays for every document"""
+        neighbors = np.full((num_docs, self.k), -1, dtype=np.int32)
+        scores = np.full((num_docs, self.k), -np.inf, dtype=np.float32)
+        with metrics.timer('similarity_graph', items=num_docs):
+            if num_docs:
+                for block, _, block_neighbors, block_scores in self._knn(np.arange(num_docs), embeddings):
+                    neighbors[block] = block_neighbors
+                    scores[block] = block_scores
+        return neighbors, scores
+
+    def build(self, doc_ids: List[str], embeddings: np.ndarray):
+        """
+        Build the k-nearest-neighbour graph from scratch
+        Embeddings must be L2-normalized, one row per doc_id
+        """
+        # Compute outside the lock so other workers' writes are not blocked meanwhile
+        neighbors, scores = self._build_arrays(embeddings, len(doc_ids))
+        with self.state.write_lock():
+            self._set(list(doc_ids), neighbors, scores)
+            self._save()
+
+    def update(self, read_index: Callable[[], Tuple[List[str], np.ndarray]], max_attempts: int = 3):
+        """
+        Bring the graph in line with the embedding index incrementally:
+        new documents get their neighbours computed and are inserted into
+        existing documents' lists where they rank in the top k; documents
+        that lost a neighbour to deletion have their row recomputed
+        Args:
+            read_index: Returns the current (doc_ids, embeddings); called on
+                every attempt, since a graph published by another worker
+                meanwhile was likely built from a newer index
+        """
+        for _ in range(max_attempts):
+            # Compute outside the lock, then publish only if nobody else wrote meanwhile
+            self.refresh()
+            version = self.version
+            doc_ids, embeddings = read_index()
+            graph = self._compute_update(doc_ids, embeddings)
+            if graph is None:
+                return
+            with self.state.write_lock():
+                self.refresh()
+                if self.version == version:
+                    self._set(list(doc_ids), *graph)
+                    self._save()
+                    return
+        print("Similarity graph changed too often while updating; it will catch up on the next update")
+        metrics.record_error('similarity_graph')
+
+    def _compute_update(self, doc_ids: List[str],
+                        embeddings: np.ndarray) -> Optional[Tuple[np.ndarray, np.ndarray]]:
+        """
+        Neighbour and score arrays for doc_ids, derived from the loaded graph
+        Returns: None when the loaded graph already matches doc_ids
+        """
+        old_ids, old_neighbors, old_scores = self.doc_ids, self.neighbors, self.scores
+        num_docs = len(doc_ids)
+        if not old_ids or not num_docs:
+            return self._build_arrays(embeddings, num_docs)
+
+        # Re-align the existing graph with the rows of the embedding index
+        old_to_new = np.full(len(old_ids) + 1, -1, dtype=np.int32)  # Last slot maps padding
+        new_index = {doc_id: i for i, doc_id in enumerate(doc_ids)}
+        for old_row, doc_id in enumerate(old_ids):
+            old_to_new[old_row] = new_index.get(doc_id, -1)
+        kept = [old_row for old_row, doc_id in enumerate(old_ids) if doc_id in new_index]
+
+        neighbors = np.full((num_docs, self.k), -1, dtype=np.int32)
+        scores = np.full((num_docs, self.k), -np.inf, dtype=np.float32)
+        is_new = np.ones(num_docs, dtype=bool)
+        dirty = np.zeros(num_docs, dtype=bool)
+        if kept:
+            kept = np.array(kept)
+            rows = old_to_new[kept]
+            neighbors[rows] = old_to_new[old_neighbors[kept]]
+            scores[rows] = old_scores[kept]
+            is_new[rows] = False
+            # Rows that pointed at a deleted document must be recomputed
+            lost = (neighbors[rows] < 0) & (old_neighbors[kept] >= 0)
+            dirty[rows[lost.any(axis=1)]] = True
+
+        if not is_new.any() and not dirty.any() and len(kept) == len(old_ids):
+            return None
+
+        recompute = np.flatnonzero(is_new | dirty)
+        targets = ~(is_new | dirty)
+        with metrics.timer('similarity_graph', items=len(recompute)):
+            for block, sims, block_neighbors, block_scores in self._knn(recompute, embeddings):
+                neighbors[block] = block_neighbors
+                scores[block] = block_scores
+                self._insert_reverse(block, sims, is_new[block], neighbors, scores, targets)
+        return neighbors, scores
+
+    def _insert_reverse(self, block: np.ndarray, sims: np.ndarray, block_is_new: np.ndarray,
+                        neighbors: np.ndarray, scores: np.ndarray, targets: np.ndarray):
+        """Insert the block's new documents into the neighbour lists of target rows they now rank in"""
+        if not block_is_new.any():
+            return
+        # Built in place to hold a single boolean matrix per block
+        beats = sims > scores[:, -1]
+        beats &= targets
+        beats[~block_is_new] = False
+        for row in np.flatnonzero(beats.any(axis=0)):
+            hits = np.flatnonzero(beats[:, row])
+            candidates = np.concatenate([neighbors[row], block[hits]])
+            candidate_scores = np.concatenate([scores[row], sims[hits, row]])
+            order = np.argsort(-candidate_scores)[:self.k]
+            neighbors[row] = candidates[order]
+            scores[row] = candidate_scores[order]
+
+    def clear(self):
+        """Remove the graph"""
+        with self.state.write_lock():
+            self._set([], np.full((0, self.k), -1, dtype=np.int32),
+                      np.full((0, self.k), -np.inf, dtype=np.float32))
+            self._save()
+
+    def similar(self, doc_id: str, top_k: Optional[int] = None) -> List[Tuple[str, float]]:
+        """Get a document's nearest neighbours from the precomputed graph"""
+        if top_k is not None and top_k < 1:
+            raise ValueError("top_k must be at least 1")
+        self.refresh()
+        row = self.row_index.get(doc_id)
+        if row is None:
+            return []
+        results = [
+            (self.doc_ids[neighbor], float(score))
+            for neighbor, score in zip(self.neighbors[row], self.scores[row])
+            if neighbor >= 0
+        ]
+        return results[:top_k] if top_k is not None else results
+
+    def duplicate_groups(self, threshold: float = 0.95) -> List[List[str]]:
+        """
+        Group documents connected by edges with similarity >= threshold
+        Returns: Groups of two or more doc_ids, largest first
+        """
+        self.refresh()
+        parent = np.arange(len(self.doc_ids))
+
+        def find(i: int) -> int:
+            while parent[i] != i:
+                parent[i] = parent[parent[i]]
+                i = parent[i]
+            return i
+
+        rows, cols = np.nonzero((self.scores >= threshold) & (self.neighbors >= 0))
+        for row, col in zip(rows, cols):
+            a, b = find(row), find(self.neighbors[row, col])
+            if a != b:
+                parent[max(a, b)] = min(a, b)
+
+        groups: Dict[int, List[str]] = {}
+        for i, doc_id in enumerate(self.doc_ids):
+            groups.setdefault(find(i), []).append(doc_id)
+        return sorted((g for g in groups.values() if len(g) > 1), key=len, reverse=True)
+
+# Global instance
+similarity_graph = SimilarityGraph()
+
@@ -0,0 +1,64 @@
+import sys
+import zlib
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+# Import the backend modules the way main.py does
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from shared_state import SharedState
+
+
+class FakeEncoder:
+    """
+    Deterministic stand-in for SentenceTransformer: texts sharing a first
+    word land near the same point, so they cluster like real topics
+    """
+    dim = 16
+
+    def __init__(self, name: str = None):
+        pass
+
+    def _vector(self, text: str) -> np.ndarray:
+        topic = np.random.default_rng(zlib.crc32(text.split()[0].encode())).standard_normal(self.dim)
+        noise = np.random.default_rng(zlib.crc32(text.encode())).standard_normal(self.dim)
+        return topic + 0.3 * noise
+
+    def encode(self, texts, normalize_embeddings: bool = False, **kwargs):
+        single = isinstance(texts, str)
+        vectors = np.array([self._vector(t) for t in ([texts] if single else texts)])
+        if normalize_embeddings:
+            vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors[0] if single else vectors
+
+
+def unit_vectors(rng: np.random.Generator, n: int, dim: int = 16) -> np.ndarray:
+    vectors = rng.standard_normal((n, dim)).astype(np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+@pytest.fixture
+def data_dir(tmp_path) -> Path:
+    return tmp_path / "data"
+
+
+@pytest.fixture
+def state(data_dir) -> SharedState:
+    return SharedState(data_dir)
+
+
+@pytest.fixture
+def make_searcher(tmp_path, data_dir, monkeypatch):
+    """Build SemanticSearch instances that share one scratch directory, like workers do"""
+    import semantic_search
+    from clustering import DocumentClusterer
+
+    monkeypatch.setattr(semantic_search, 'SentenceTransformer', FakeEncoder)
+
+    def make():
+        state = SharedState(data_dir)
+        clusterer = DocumentClusterer(tmp_path / "models", state)
+        return semantic_search.SemanticSearch(data_dir, state, clusterer)
+    return make
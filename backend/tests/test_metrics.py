@@ -0,0 +1,55 @@
+import json
+
+import pytest
+
+import metrics
+
+
+def test_merged_registry_totals_other_workers():
+    worker = metrics.MetricsRegistry()
+    worker.counter("jobs_total", "Jobs").inc(2, stage="encode")
+    worker.histogram("job_seconds", "Job time").observe(0.02, stage="encode")
+
+    peer = metrics.MetricsRegistry()
+    peer.counter("jobs_total", "Jobs").inc(3, stage="encode")
+    peer.counter("jobs_total", "Jobs").inc(1, stage="search")
+    peer.histogram("job_seconds", "Job time").observe(2.0, stage="encode")
+
+    rendered = worker.merged([json.loads(json.dumps(peer.snapshot()))]).render()
+    assert 'jobs_total{stage="encode"} 5' in rendered
+    assert 'jobs_total{stage="search"} 1' in rendered
+    assert 'job_seconds_count{stage="encode"} 2' in rendered
+
+
+def test_exporter_reads_live_peer_snapshots(tmp_path):
+    first = metrics.WorkerExporter(tmp_path)
+    second = metrics.WorkerExporter(tmp_path)
+    second.path = tmp_path / "worker-peer.json"
+    second.flush()
+
+    peers = first.peer_snapshots()
+    assert len(peers) == 1 and 'metrics' in peers[0]
+
+    # Snapshots of workers that stopped publishing are dropped
+    first.stale_after = -1
+    assert first.peer_snapshots() == []
+    assert not second.path.exists()
+
+
+def test_leftover_profiler_state_does_not_survive_a_restart(tmp_path):
+    control = tmp_path / "profiler.json"
+    control.write_text(json.dumps({'running': True, 'interval': 0.01, 'generation': 4}))
+    exporter = metrics.WorkerExporter(tmp_path, flush_interval=60)
+    exporter.start()
+    try:
+        exporter.sync_profiler()
+        assert not metrics.profiler.running
+        assert json.loads(control.read_text())['running'] is False
+    finally:
+        exporter.stop()
+        metrics.profiler.stop()
+
+
+def test_profiler_rejects_non_positive_interval():
+    with pytest.raises(ValueError):
+        metrics.SamplingProfiler().start(0)
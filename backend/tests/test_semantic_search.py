@@ -0,0 +1,81 @@
+import numpy as np
+import pytest
+
+import semantic_search
+from conftest import FakeEncoder
+
+TOPICS = ['market', 'patient', 'football', 'software']
+
+
+def documents(start: int, count: int) -> dict:
+    return {
+        f"doc_{i}": {'preprocessed_text': f"{TOPICS[i % len(TOPICS)]} story number {i}"}
+        for i in range(start, start + count)
+    }
+
+
+def expected_vector(doc: dict) -> np.ndarray:
+    return FakeEncoder().encode(doc['preprocessed_text'], normalize_embeddings=True)
+
+
+def test_appends_are_shared_and_survive_growth(make_searcher, monkeypatch):
+    monkeypatch.setattr(semantic_search, 'MIN_CAPACITY', 4)
+    first, second = make_searcher(), make_searcher()
+    added = {}
+    for batch in range(12):
+        docs = documents(3 * batch, 3)
+        (first if batch % 2 else second).embed_documents(docs)
+        added.update(docs)
+
+    for searcher in (first, second):
+        searcher.refresh()
+        assert sorted(searcher.doc_ids) == sorted(added)
+        for doc_id, doc in added.items():
+            assert np.allclose(searcher.embeddings[searcher.row_index[doc_id]], expected_vector(doc), atol=1e-6)
+
+
+def test_appends_do_not_rewrite_the_matrix(make_searcher):
+    searcher = make_searcher()
+    searcher.embed_documents(documents(0, 5))
+    matrix = searcher._index['matrix']
+    searcher.embed_documents(documents(5, 5))
+    assert searcher._index['matrix'] == matrix
+    assert len(searcher.doc_ids) == 10
+
+
+def test_remove_and_clear(make_searcher):
+    first, second = make_searcher(), make_searcher()
+    first.embed_documents(documents(0, 8))
+    second.remove_documents(['doc_2', 'doc_5'])
+    present, rows = first.get_embeddings(['doc_1', 'doc_2', 'doc_7'])
+    assert present == ['doc_1', 'doc_7']
+    assert np.allclose(rows[1], expected_vector(documents(7, 1)['doc_7']), atol=1e-6)
+
+    second.clear()
+    first.refresh()
+    assert first.doc_ids == [] and first.embeddings is None
+    assert sorted(p.name for p in first.data_dir.iterdir()) == ['state.lock', 'state_versions.json']
+
+
+def test_deleted_documents_are_not_re_embedded(make_searcher):
+    searcher = make_searcher()
+    searcher.embed_documents(documents(0, 4), still_exists=lambda doc_id: doc_id != 'doc_1')
+    assert sorted(searcher.doc_ids) == ['doc_0', 'doc_2', 'doc_3']
+
+
+def test_pruned_search(make_searcher):
+    searcher = make_searcher()
+    docs = documents(0, 200)
+    searcher.embed_documents(docs)
+    doc_ids, vectors = searcher.get_embeddings(list(docs))
+    searcher.clusterer.cluster_documents(vectors, len(TOPICS), doc_ids)
+
+    for topic in TOPICS:
+        query = f"{topic} latest news"
+        exact = searcher.search(query)
+        assert searcher.search(query, nprobe=len(TOPICS)) == exact
+        pruned = {doc_id for doc_id, _ in searcher.search(query, nprobe=1)}
+        assert len(pruned & {doc_id for doc_id, _ in exact}) >= 9
+
+    with pytest.raises(ValueError):
+        searcher.search("market", nprobe=0)
@@ -0,0 +1,73 @@
+import subprocess
+import sys
+from pathlib import Path
+
+import pytest
+
+from data_store import DocumentStore
+from shared_state import SharedState, atomic_write
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent
+
+
+def test_bump_version_counts_per_key(state):
+    assert state.get_version('documents') == 0
+    assert state.bump_version('documents') == 1
+    assert state.bump_version('documents') == 2
+    assert state.bump_version('embeddings') == 1
+    assert state.get_version('documents') == 2
+
+
+def test_rapid_bumps_are_seen_by_other_instances(data_dir):
+    # Back-to-back replacements can reuse an inode within one mtime tick
+    writer, reader = SharedState(data_dir), SharedState(data_dir)
+    for i in range(1, 201):
+        key = ('embeddings', 'cluster_index', 'documents')[i % 3]
+        writer.bump_version(key)
+        reader.bump_version('other')
+        assert writer.get_version('other') == i
+        assert reader.get_version(key) == writer.get_version(key)
+
+
+def test_concurrent_bumps_from_processes_are_not_lost(data_dir):
+    script = (
+        "import sys; sys.path.insert(0, sys.argv[1])\n"
+        "from shared_state import SharedState\n"
+        "state = SharedState(sys.argv[2])\n"
+        "for _ in range(50): state.bump_version('documents')\n"
+    )
+    workers = [
+        subprocess.Popen([sys.executable, '-c', script, str(BACKEND_DIR), str(data_dir)])
+        for _ in range(4)
+    ]
+    assert all(worker.wait() == 0 for worker in workers)
+    assert SharedState(data_dir).get_version('documents') == 200
+
+
+def test_atomic_write_keeps_old_file_on_failure(tmp_path):
+    path = tmp_path / "file.txt"
+    atomic_write(path, lambda f: f.write(b"old"))
+
+    def fail(f):
+        f.write(b"partial")
+        raise RuntimeError("disk full")
+
+    with pytest.raises(RuntimeError):
+        atomic_write(path, fail)
+    assert path.read_bytes() == b"old"
+    assert [p.name for p in tmp_path.iterdir()] == ["file.txt"]
+
+
+def test_document_stores_do_not_lose_each_others_writes(data_dir):
+    first, second = DocumentStore(data_dir, SharedState(data_dir)), DocumentStore(data_dir, SharedState(data_dir))
+    ids = []
+    for i in range(20):
+        store = first if i % 2 else second
+        ids.append(store.store_document(f"doc_{i}.txt", '.txt', f"text {i}"))
+    first.update_documents({doc_id: {'cluster': 1} for doc_id in ids[:5]})
+    second.delete_document(ids[-1])
+
+    for store in (first, second):
+        documents = store.get_all_documents()
+        assert set(documents) == set(ids[:-1])
+        assert [documents[doc_id]['cluster'] for doc_id in ids[:5]] == [1] * 5
@@ -0,0 +1,121 @@
+import tracemalloc
+
+import numpy as np
+import pytest
+
+from conftest import unit_vectors
+from shared_state import SharedState
+from similarity_graph import SimilarityGraph
+
+
+def make_graph(data_dir, **kwargs) -> SimilarityGraph:
+    return SimilarityGraph(data_dir=data_dir, state=SharedState(data_dir), **kwargs)
+
+
+def neighbour_map(graph: SimilarityGraph) -> dict:
+    return {doc_id: dict(graph.similar(doc_id)) for doc_id in graph.doc_ids}
+
+
+def assert_same_graph(graph: SimilarityGraph, expected: SimilarityGraph):
+    assert sorted(graph.doc_ids) == sorted(expected.doc_ids)
+    got, want = neighbour_map(graph), neighbour_map(expected)
+    for doc_id, neighbours in want.items():
+        assert got[doc_id].keys() == neighbours.keys(), doc_id
+        for neighbour, score in neighbours.items():
+            assert got[doc_id][neighbour] == pytest.approx(score, abs=1e-5)
+
+
+def test_incremental_update_matches_rebuild(tmp_path):
+    rng = np.random.default_rng(0)
+    # A tiny block budget forces many blocks
+    incremental = make_graph(tmp_path / "incremental", max_block_mb=0.01)
+    rebuilt = make_graph(tmp_path / "rebuilt", max_block_mb=0.01)
+
+    doc_ids = [f"doc_{i}" for i in range(300)]
+    embeddings = unit_vectors(rng, 300)
+    incremental.update(lambda: (doc_ids, embeddings))
+    next_id = 300
+
+    for round_number in range(6):
+        # Delete a random subset, then append new documents
+        keep = np.sort(rng.choice(len(doc_ids), size=len(doc_ids) - 30, replace=False))
+        added = 60 if round_number % 2 == 0 else 1
+        doc_ids = [doc_ids[i] for i in keep] + [f"doc_{next_id + i}" for i in range(added)]
+        embeddings = np.vstack([embeddings[keep], unit_vectors(rng, added)])
+        next_id += added
+
+        incremental.update(lambda: (doc_ids, embeddings))
+        rebuilt.build(doc_ids, embeddings)
+        assert_same_graph(incremental, rebuilt)
+
+
+def test_update_is_shared_between_workers(data_dir):
+    rng = np.random.default_rng(1)
+    first, second = make_graph(data_dir), make_graph(data_dir)
+    doc_ids = [f"doc_{i}" for i in range(50)]
+    embeddings = unit_vectors(rng, 50)
+    first.update(lambda: (doc_ids, embeddings))
+
+    doc_ids, embeddings = doc_ids[5:] + ["new"], np.vstack([embeddings[5:], unit_vectors(rng, 1)])
+    second.update(lambda: (doc_ids, embeddings))
+    assert first.similar("new") == second.similar("new")
+    assert first.similar("doc_0") == []
+
+
+def test_retry_uses_the_current_index(data_dir):
+    rng = np.random.default_rng(2)
+    graph, other_worker = make_graph(data_dir), make_graph(data_dir)
+    old_ids = [f"doc_{i}" for i in range(40)]
+    old_embeddings = unit_vectors(rng, 40)
+    graph.build(old_ids, old_embeddings)
+
+    # Another worker publishes a graph from a newer index while this one computes
+    new_ids = old_ids[10:] + [f"new_{i}" for i in range(10)]
+    new_embeddings = np.vstack([old_embeddings[10:], unit_vectors(rng, 10)])
+    calls = []
+
+    def read_index():
+        calls.append(1)
+        if len(calls) == 1:
+            other_worker.build(new_ids, new_embeddings)
+            return old_ids + ["stale"], np.vstack([old_embeddings, unit_vectors(rng, 1)])
+        return new_ids, new_embeddings
+
+    graph.update(read_index)
+    assert len(calls) == 2
+    expected = make_graph(data_dir.parent / "expected")
+    expected.build(new_ids, new_embeddings)
+    assert_same_graph(graph, expected)
+
+
+def test_duplicates_and_similar(data_dir):
+    rng = np.random.default_rng(3)
+    embeddings = unit_vectors(rng, 20)
+    embeddings[7] = embeddings[3]
+    embeddings[12] = embeddings[3]
+    graph = make_graph(data_dir, k=5)
+    graph.build([f"doc_{i}" for i in range(20)], embeddings)
+
+    assert graph.duplicate_groups(0.999) == [['doc_3', 'doc_7', 'doc_12']]
+    similar = graph.similar('doc_3', top_k=2)
+    assert {doc_id for doc_id, _ in similar} == {'doc_7', 'doc_12'}
+    assert len(graph.similar('doc_3')) == 5
+    with pytest.raises(ValueError):
+        graph.similar('doc_3', top_k=0)
+
+
+def test_block_memory_stays_within_budget(data_dir):
+    num_docs = 4000
+    embeddings = unit_vectors(np.random.default_rng(4), num_docs, dim=32)
+    graph = make_graph(data_dir, max_block_mb=4)
+
+    tracemalloc.start()
+    try:
+        baseline = tracemalloc.get_traced_memory()[0]
+        graph._build_arrays(embeddings, num_docs)
+        peak_mb = (tracemalloc.get_traced_memory()[1] - baseline) / (1024 * 1024)
+    finally:
+        tracemalloc.stop()
+    # The output arrays come on top of the per-block budget
+    output_mb = num_docs * graph.k * 8 / (1024 * 1024)
+    assert peak_mb <= graph.max_block_mb + output_mb + 0.5
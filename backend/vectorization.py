@@ -3,6 +3,7 @@ from typing import List
 import numpy as np
 from scipy.sparse import spmatrix, csr_matrix
 import torch
+import metrics
 
 class DocumentVectorizer:
     def __init__(self):
@@ -20,9 +21,10 @@ class DocumentVectorizer:
         Returns: Sparse matrix for compatibility with existing code
         """
         # Get dense vectors from the transformer model
-        self.vectors = self.model.encode(processed_texts, 
-                                       convert_to_tensor=True,
-                                       show_progress_bar=True)
+        with metrics.timer('encoding', items=len(processed_texts)):
+            self.vectors = self.model.encode(processed_texts, 
+                                           convert_to_tensor=True,
+                                           show_progress_bar=True)
         
         # Convert to numpy and then to sparse matrix for compatibility
         numpy_vectors = self.vectors.cpu().numpy()
@@ -31,7 +33,8 @@ class DocumentVectorizer:
         
     def transform_single_document(self, processed_text: str) -> spmatrix:
         """Transform a single document into a vector"""
-        vector = self.model.encode([processed_text], convert_to_tensor=True)
+        with metrics.timer('encoding', items=1):
+            vector = self.model.encode([processed_text], convert_to_tensor=True)
         return csr_matrix(vector.cpu().numpy())
     
     def get_vectors(self) -> spmatrix: